@@ -1,5 +1,5 @@
 """
-Script designed to download large numbers of files one at at time. Script is capable of monitoring download stream to detect dead streams, in which case the file will be deleted and the download restarted.
+Script designed to download large numbers of files one at at time. Script is capable of monitoring download stream to detect dead streams, in which case the download will be resumed where it left off (or, if the server does not allow that, deleted and restarted).
 
 Script also provides functionality for checking if a file has been completely downloaded, although it does not directly invoke this functionality by default as it can add immense amount of processing time to the total download time.
 
@@ -14,34 +14,96 @@ Phone No: +1-(907)-500-5430
 import sys
 sys.path.append( r"N:\Python Scripts\BathymetryProcessor" )
 import urllib
-import random
+import urllib2
 import os.path
 import time
-from multiprocessing import Process as proc
+from collections import deque
 import datetime
 import traceback
+import socket
+import errno
+import httplib
+import downloadPool
+import serverProfiles
+import metadataIndex
+import integrity
+import extraction
+import metrics
+import politeness
+import backoff
+import outputLayout
+import partFiles
+import workItems
+import tracing
+import threading
 
-proc_check_time = 10 # The number of seconds the main process will wait between file size checks (which are done to determine download stream activity)
 dl_att_thshold = 5 # The number of times the script will attempt to download a file before abandoning it. Set to -1 for infinite attempts.
-max_dead_cycles = 4 # The number of cycles the script will wait for the download stream to restart once it has died.
-base_wait_time = 2 # This will be multiplied by a random value between .5 and 1.5 between each download to determine the number of seconds the script will wait. Its an attempt to prevent the server from kicking us off.
+base_wait_time = 2 # The minimum number of seconds between the start of one request to a server and the next, varied by up to request_jitter either way each time. Its an attempt to prevent the server from kicking us off. Waiting on one server never holds up downloads from another.
+request_jitter = 0.5 # How far either way of base_wait_time the wait between requests to the same server can vary, as a fraction of base_wait_time.
 restart_wait_time = 5 # The number of seconds the script will pause when restarting a download
-file_creation_wait_limit = 60 # The number of seconds the script will wait for the file to be created before asumming an error has occurred.
+read_timeout = 10 # The number of seconds a read from the download stream may block before the stream is considered dead.
+stall_window = 10 # The number of seconds of transfer history the stream watchdog looks at when judging the health of the download stream.
+min_throughput = 512 # The average rate, in bytes per second over the last stall_window seconds, below which the download stream is considered dead.
 dl_completion_threshold = 1.0 # The percentage of the file which must be downloaded for the file to be considered 'completely' downloaded. Useful if there is a consistant difference between file size once downloaded, even when download is truly complete, or when a file can still be used when <100% complete (CSV files, eg.).
-# If set to true, the script will check each file already downloaded for completeness. Can take a long time, because for each file you have to ask the server for the size of the file on their disk, which usually takes a few seconds per request. So for 10,000 files it can take several hours to check
+# If set to true, the script will check each file already downloaded for completeness. Files are only ever put in place once they're complete (see partFiles.py), so this is only needed for files downloaded by older versions of the script, or copied in by hand. Files downloaded by this script are checked against the size recorded when they were downloaded, in the download journal or (if there isn't one) the download directory's metadata index (see getRecordedSize), which is quick. Files with no size recorded mean asking the server for the size of the file on their disk, which usually takes a few seconds per request. So for 10,000 such files it can take several hours to check
 checkDownloadCompleteness = False
+max_concurrent_downloads = 8 # The maximum number of files that will be downloaded at the same time, across all servers.
+max_conns_per_host = 2 # The maximum number of files that will be downloaded at the same time from any single server. Some servers (the bathymetry server among them) will close ALL of our connections if we open more than ~3 at once.
+# If set to true, the number of connections to each server starts low and is gradually ramped up (never above max_conns_per_host) until the server starts forcibly closing connections, at which point it is backed off. What each server tolerated is remembered in server_profiles_fp for the next run.
+adaptive_concurrency = True
+server_profiles_fp = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), 'server_profiles.json' )
+server_controller = None # The serverProfiles.AdaptiveController in use by dlFilesFromList, if adaptive_concurrency is on. It is kept between calls to dlFilesFromList, so that a new batch of urls doesn't forget a server's current limit or cool down.
+download_journal = None # The downloadJournal.DownloadJournal passed to dlFilesFromList, if any.
+resume_downloads = True # If set to true, a dead download stream is picked back up where it left off (using an HTTP Range request) instead of being deleted and started over, whenever the server allows it.
+dl_chunk_size = 64 * 1024 # The number of bytes read from the download stream and written to disk at a time.
+write_buffer_size = 1024 * 1024 # The number of bytes buffered up before being written out to disk. Fewer, larger writes go a lot easier on network drives.
+preallocate_downloads = False # If set to true, each file is made its full size on disk before the download starts, so that NTFS can give it one unbroken run of space rather than growing it piecemeal.
+host_bandwidth_limit = None # The most bytes per second we will pull from any one server. None for no limit. Keep it well above min_throughput, or the stream watchdog will take the throttling for a stalled stream.
+total_bandwidth_limit = None # The most bytes per second we will pull from all servers put together. None for no limit.
+bandwidth_limiter = None # The politeness.BandwidthLimiter in use, if either of the limits above is set. It is kept between calls to dlFilesFromList.
+# If set to true, large files are split into segments which are downloaded over several connections at once, whenever the server accepts range requests. Every extra connection counts against max_conns_per_host, just like a separate download would, so a server that won't take more than one connection from us gets one.
+segmented_downloads = False
+segment_threshold = 256 * 1024 * 1024 # Files smaller than this many bytes are always downloaded over a single connection.
+segment_size = 32 * 1024 * 1024 # The size of each segment, in bytes. Each connection works through the segments one at a time, so a slow connection just ends up doing fewer of them.
+max_segment_connections = 4 # The most connections a single file will be downloaded over at once.
+download_pool = None # The downloadPool.DownloadPool running the downloads for dlFilesFromList, which hands out the extra connections for segmented downloads.
+request_spacer = None # The politeness.RequestSpacer in use, if base_wait_time is set. It is kept between calls to dlFilesFromList, so that a new batch of urls doesn't mean a burst of requests.
+digest_algorithm = 'sha256' # The hash algorithm (any name hashlib knows) used to compute a digest of each file as it downloads. The digests are written to a manifest file in the download directory. Set to None to skip it.
+checksum_list_fp = None # The path of a checksum list (in the format written by md5sum or sha256sum) to check downloaded files against. Checksums sent by the server in Content-MD5 or Digest headers are always checked.
+extract_dir = None # If set to a directory, .gz files are decompressed into it as they download (see extraction.py).
 verbose = True # Set to true for the script to describe its behaviour in real time via the console
 
 
-#Not working yet
-loop_dl_attempts = True # If true, failed download attempts (after reaching the attempt threshold^^) will be relocated to the back of the list to be tried again later.
+loop_dl_attempts = True # If true, failed downloads are tried again later in the same run, waiting longer after each failure (see backoff.py). Urls that fail backoff.max_attempts times are quarantined.
+failed_attempts = {} # url -> number of failed attempts at it, for when there's no journal to keep count
+failure_statuses = {} # url -> the HTTP error status its last attempt failed with, waiting to be passed to scheduleRetry
 
-class FileNotCreatedException( Exception ):
+class DownloadStreamDeadException( Exception ):
 	pass
 
-class DownloadStreamDeadException( Exception ):
+class DownloadStreamStalledException( Exception ):
+	pass
+
+class ConnectionForciblyClosedException( Exception ):
 	pass
 
+class SegmentedDownloadException( Exception ):
+	pass
+
+forced_close_errnos = ( errno.ECONNRESET, errno.ECONNABORTED, errno.ECONNREFUSED, errno.EPIPE )
+
+# Returns true if the passed exception looks like the server deliberately dropping our connection, rather than some other failure (a bad url, a full disk, etc.)
+def isForcedClose( e ):
+	if isinstance( e, ( ConnectionForciblyClosedException, httplib.BadStatusLine, httplib.IncompleteRead, urllib.ContentTooShortError ) ):
+		return True
+	# urllib2 wraps errors from opening the connection (a refusal, or a reset before the response arrives) up as URLError( reason ), where reason is the socket.error
+	if isinstance( e, urllib2.URLError ) and isinstance( getattr( e, 'reason', None ), socket.error ):
+		e = e.reason
+	# urllib (still used by getFileSizeOnServer) wraps them up as IOError( 'socket error', err )
+	elif not isinstance( e, socket.error ) and isinstance( e, IOError ) and len( e.args ) == 2 and isinstance( e.args[1], socket.error ):
+		e = e.args[1]
+	return isinstance( e, socket.error ) and e.errno in forced_close_errnos
+
 def printIfVerbose( message ):
 	if verbose == True:
 		print( message )
@@ -65,23 +127,375 @@ def getNameFromURL( url ):
 	name = basename.split( '.' )[0]
 	return name
 
-# Function used to cleanly restart a dead download stream
-def restartDL( p, f_path, url ):
-	p.terminate()
-	time.sleep( restart_wait_time )
-	os.remove( f_path ) # Delete the old file so that the new one doesn't hit it
-	p = proc( target=dlFile, args=( url, f_path ) )
-	p.start()
-	return p
+# Watches the download stream as it is read, and raises DownloadStreamStalledException if the average transfer rate over the last stall_window seconds drops below min_throughput.
+# Reads that block outright are caught by read_timeout instead, since no data means update() is never called.
+class StreamWatchdog( object ):
+	def __init__( self, expected_size=None ):
+		self.expected_size = expected_size
+		self.samples = deque() # ( time, bytes ) for every chunk received in the last stall_window seconds
+		self.window_bytes = 0
+		self.received = 0
+		self.start_time = time.time()
+		self.last_report = self.start_time
+
+	def update( self, num_bytes ):
+		now = time.time()
+		self.samples.append( ( now, num_bytes ) )
+		self.window_bytes += num_bytes
+		self.received += num_bytes
+		while self.samples[0][0] < now - stall_window:
+			self.window_bytes -= self.samples.popleft()[1]
+		rate = float( self.window_bytes ) / stall_window
+		if now - self.last_report >= stall_window:
+			printIfVerbose( "Curr size: %s/%s - DL Rate: %s B/s" % ( self.received, self.expected_size, rate ) )
+			self.last_report = now
+		# The stream can't be judged until it has been running for a full window
+		if now - self.start_time >= stall_window and rate < min_throughput:
+			raise DownloadStreamStalledException( "Download stream fell to %s B/s" % rate )
+
+# Works out where the next attempt at downloading f_path should start from, after the stream died.
+# Returns ( offset, validator ). If the server told us (through server_info, see getResponseInfo) that it accepts range requests, the download continues from the end of the partial file. Otherwise the partial file is deleted and the download starts again from the beginning.
+def getResumePoint( f_path, server_info ):
+	validator = getResumeValidator( server_info )
+	part_fp = partFiles.getPartPath( f_path )
+	if resume_downloads == True and validator is not None and os.path.isfile( part_fp ):
+		return ( os.path.getsize( part_fp ), validator )
+	partFiles.discard( f_path ) # Delete the old file so that the new one doesn't hit it
+	return ( 0, None )
+
+# Returns the value we should send in an If-Range header to safely resume a download of the file described by server_info, or None if the file can't be safely resumed.
+# If-Range only accepts strong ETags, so a weak ETag falls back to the Last-Modified date.
+def getResumeValidator( server_info ):
+	if not server_info or not server_info['accept_ranges']:
+		return None
+	etag = server_info['etag']
+	if etag is not None and not etag.startswith( 'W/' ):
+		return etag
+	return server_info['last_modified']
+
+# socket.create_connection, with the address lookup and the connect itself traced separately (see tracing.py). Only used while tracing is on.
+def createTracedConnection( address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None ):
+	host, port = address
+	with tracing.tracer.span( 'dns', host=host ):
+		addresses = socket.getaddrinfo( host, port, 0, socket.SOCK_STREAM )
+	err = None
+	for af, socktype, proto, canonname, sa in addresses:
+		sock = None
+		try:
+			with tracing.tracer.span( 'connect', host=host ):
+				sock = socket.socket( af, socktype, proto )
+				if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+					sock.settimeout( timeout )
+				if source_address:
+					sock.bind( source_address )
+				sock.connect( sa )
+			return sock
+		except socket.error as e:
+			err = e
+			if sock is not None:
+				sock.close()
+	if err is not None:
+		raise err
+	raise socket.error( "getaddrinfo returns an empty list" )
+
+# Connections that record in the metrics how long they took to open, so that slow connects can be told apart from slow servers.
+class TimedHTTPConnection( httplib.HTTPConnection ):
+	def connect( self ):
+		if tracing.tracer.enabled == True:
+			self._create_connection = createTracedConnection
+		start = time.time()
+		httplib.HTTPConnection.connect( self )
+		metrics.registry.observe( 'download_connect_seconds', time.time() - start, { 'host': getConnectionHost( self ) } )
+
+class TimedHTTPSConnection( httplib.HTTPSConnection ):
+	def connect( self ):
+		if tracing.tracer.enabled == True:
+			self._create_connection = createTracedConnection
+		start = time.time()
+		# The lookup and the connect are spans of their own, inside this one, so what's left of it is the TLS handshake
+		with tracing.tracer.span( 'tls', host=self.host ):
+			httplib.HTTPSConnection.connect( self )
+		metrics.registry.observe( 'download_connect_seconds', time.time() - start, { 'host': getConnectionHost( self ) } )
+
+# Returns the host a connection is to, in the same form as downloadPool.getHost
+def getConnectionHost( conn ):
+	if conn.port == conn.default_port:
+		return conn.host.lower()
+	return ( "%s:%s" % ( conn.host, conn.port ) ).lower()
+
+class TimedHTTPHandler( urllib2.HTTPHandler ):
+	def http_open( self, req ):
+		return self.do_open( TimedHTTPConnection, req )
+
+class TimedHTTPSHandler( urllib2.HTTPSHandler ):
+	def https_open( self, req ):
+		return self.do_open( TimedHTTPSConnection, req, context=self._context )
+
+download_opener = urllib2.build_opener( TimedHTTPHandler, TimedHTTPSHandler )
+
+# Opens the download stream for url. If offset is non-zero, only the bytes from offset onward are asked for, on the condition (If-Range) that the file on the server still matches validator. If it doesn't, the server sends back the whole file instead.
+# If end is given, only the bytes up to and including end are asked for.
+def openDownloadStream( url, offset=0, validator=None, end=None ):
+	req = urllib2.Request( url )
+	if offset > 0 or end is not None:
+		req.add_header( 'Range', 'bytes=%d-%s' % ( offset, end if end is not None else '' ) )
+		if validator is not None:
+			req.add_header( 'If-Range', validator )
+	with tracing.tracer.span( 'request', url=url, offset=offset ):
+		return download_opener.open( req, timeout=read_timeout )
+
+# Returns a dict describing the file behind the download stream d: its full size, its ETag and Last-Modified date (if the server gives them), and whether the server accepts range requests for it.
+def getResponseInfo( d ):
+	info = d.info()
+	size = info.getheader( 'Content-Length' )
+	content_range = info.getheader( 'Content-Range' )
+	if d.getcode() == 206 and content_range is not None and not content_range.endswith( '/*' ):
+		size = content_range.split( '/' )[-1] # A range response only gives the length of the range. The full size is after the slash.
+	response_info = {
+		'size': int( size ) if size is not None else None,
+		'etag': info.getheader( 'ETag' ),
+		'last_modified': info.getheader( 'Last-Modified' ),
+		'accept_ranges': 'bytes' in info.getheader( 'Accept-Ranges', '' ),
+	}
+	# A checksum sent with a range response may only be for the range, so we only take them from whole file responses
+	if d.getcode() == 200:
+		response_info['checksums'] = integrity.getServerChecksums( info )
+	return response_info
 
 # The basic download function
-def dlFile( url, f_path ):	
+# The file is written to f_path + '.part' (see partFiles.py), and synced to disk once it is all there. Moving it to f_path is left to the caller, once it has checked it.
+# If offset is non-zero the download is resumed, and the new bytes are appended to the partial file.
+# If a server_info dict is passed, it is filled in with what the server told us about the file (see getResponseInfo) as soon as the response arrives, so that it is available to the caller even if the stream later dies.
+# If an integrity.StreamHasher is passed, every byte written to the file is also run through it. The same goes for an extraction.StreamExtractor. Both are reset whenever the file is started over from the beginning.
+def dlFile( url, f_path, offset=0, validator=None, server_info=None, hasher=None, extractor=None ):
 	printIfVerbose(  "Downloading %s" % url )
-	urllib.urlretrieve( url, f_path )
-	urllib.urlcleanup()
+	labels = { 'host': downloadPool.getHost( url ) }
+	start_time = time.time()
+	first_byte_time = None
+	d = openDownloadStream( url, offset, validator )
+	metrics.registry.add( 'download_active_connections', 1, labels )
+	try:
+		if server_info is not None:
+			server_info.update( getResponseInfo( d ) )
+		# A 206 means the server honoured our range request. Anything else is the whole file, so whatever we had gets overwritten.
+		if offset > 0 and d.getcode() == 206:
+			mode = 'ab'
+		else:
+			mode = 'wb'
+			if hasher is not None:
+				hasher.reset( integrity.getServerChecksums( d.info() ).keys() ) # Make sure we compute whatever the server gave us a checksum for
+			if extractor is not None:
+				extractor.reset()
+			if shouldSegment( d ):
+				extra = acquireSegmentConnections( url, getResponseInfo( d )['size'] )
+				# With no connections to spare, splitting the file would just mean closing this stream and opening a new one for each segment in turn, which a server counting our connections may count against us. So we carry on with this one.
+				if extra > 0:
+					return dlFileSegmented( url, f_path, d, extra, hasher, extractor )
+		expected = d.info().getheader( 'Content-Length' )
+		watchdog = StreamWatchdog( expected )
+		preallocated = mode == 'wb' and preallocate_downloads == True and expected is not None
+		with open( partFiles.getPartPath( f_path ), mode, write_buffer_size ) as f:
+			if preallocated:
+				with tracing.tracer.span( 'preallocate' ):
+					f.truncate( int( expected ) )
+			try:
+				# Each chunk's time is split between the phases it goes through (see tracing.Span.lap). Whatever isn't split off is time spent waiting on the network.
+				with tracing.tracer.span( 'transfer', url=url, offset=offset ) as span:
+					while True:
+						chunk = d.read( dl_chunk_size )
+						span.lap()
+						if not chunk:
+							break
+						if first_byte_time is None:
+							first_byte_time = time.time()
+							metrics.registry.observe( 'download_first_byte_seconds', first_byte_time - start_time, labels )
+						f.write( chunk )
+						span.lap( 'disk_write' )
+						if hasher is not None:
+							hasher.update( chunk )
+							span.lap( 'hashing' )
+						if extractor is not None:
+							extractor.update( chunk )
+							span.lap( 'extraction' )
+						metrics.registry.mark( 'download_bytes_total', 'download_bytes_per_second', len( chunk ), labels )
+						if bandwidth_limiter is not None:
+							bandwidth_limiter.consume( labels['host'], len( chunk ) )
+							span.lap( 'throttle' )
+						watchdog.update( len( chunk ) )
+					span.set( 'bytes', watchdog.received )
+				# urlretrieve used to catch this for us
+				if expected is not None and watchdog.received < int( expected ):
+					raise urllib.ContentTooShortError( "retrieval incomplete: got only %i out of %s bytes" % ( watchdog.received, expected ), None )
+			except Exception:
+				# Cut off the preallocated space we never got to, or a resumed download would take it for part of the file
+				if preallocated:
+					f.truncate( f.tell() )
+				raise
+			with tracing.tracer.span( 'disk_sync' ):
+				partFiles.sync( f )
+	finally:
+		d.close()
+		metrics.registry.add( 'download_active_connections', -1, labels )
+	if first_byte_time is not None:
+		metrics.registry.observe( 'download_transfer_seconds', time.time() - first_byte_time, labels )
 	printIfVerbose(  "Finished.")
 	return True
 
+# Returns true if the file behind the download stream d (a response to a plain request for the whole file) should be downloaded in segments.
+def shouldSegment( d ):
+	if segmented_downloads == False or d.getcode() != 200:
+		return False
+	info = getResponseInfo( d )
+	# Without a validator there'd be no way of knowing that every segment came from the same version of the file
+	return info['size'] is not None and info['size'] >= segment_threshold and getResumeValidator( info ) is not None
+
+# Returns the number of extra connections (besides the one the download already has) a segmented download of a file of size bytes from url may open. Each is asked of download_pool, so that the server never gets more connections from us than max_conns_per_host. They have to be given back with releaseSegmentConnections.
+def acquireSegmentConnections( url, size ):
+	num_segments = ( size + segment_size - 1 ) // segment_size
+	wanted = max( 0, min( max_segment_connections, num_segments ) - 1 )
+	if download_pool is not None:
+		return download_pool.acquireConnections( downloadPool.getHost( url ), wanted )
+	return max( 0, min( wanted, max_conns_per_host - 1 ) )
+
+def releaseSegmentConnections( url, extra ):
+	if download_pool is not None and extra > 0:
+		download_pool.releaseConnections( downloadPool.getHost( url ), extra )
+
+# Downloads the file behind the download stream d in segments, over several connections at once. The segments are written straight into their places in a file the full size of the download, so nothing needs to be put back together afterwards. If a segment stalls it is picked back up where it left off, independently of the others.
+# d, which is open on the whole file, reads from the start, and carries straight on into each following segment until it reaches one another connection has already taken. The other connections (extra of them, which the caller has got from acquireSegmentConnections and which are given back before this returns) take their segments from the far end of the file.
+# That way d is never closed part way and replaced with a new request. A server that counts our connections may go on counting a stream we've closed part way for a little while afterwards, and take the new request for one too many.
+# Like dlFile, the file is assembled under f_path + '.part', and left there for the caller to check and move into place. Since the segments arrive out of order, the hasher and extractor are fed from the finished file.
+def dlFileSegmented( url, f_path, d, extra, hasher=None, extractor=None ):
+	try:
+		info = getResponseInfo( d )
+		size = info['size']
+		validator = getResumeValidator( info )
+		segments = deque( [ start, min( start + segment_size, size ) - 1 ] for start in range( 0, size, segment_size ) )
+		first = segments.popleft()
+		printIfVerbose( "Downloading %s in %s segments over %s connections" % ( url, len( segments ) + 1, extra + 1 ) )
+		part_fp = partFiles.getPartPath( f_path )
+		with open( part_fp, 'wb' ) as f:
+			f.truncate( size ) # Make the file its full size up front, so that each segment can be written in place
+	except Exception:
+		releaseSegmentConnections( url, extra )
+		raise
+	lock = threading.Lock()
+	errors = []
+
+	# Works through the segments from the far end of the file until there are none left, or one of the other connections has failed. If d is passed, it reads on from segment for as long as the segments that follow it are free instead (see follow).
+	def work( d=None, segment=None ):
+		try:
+			while segment is not None:
+				with tracing.tracer.span( 'segment', url=url, start=segment[0], end=segment[1] ):
+					dlSegment( url, part_fp, segment[0], segment[1], validator, d, errors, follow if d is not None else None )
+				if d is not None:
+					return
+				with lock:
+					segment = segments.pop() if segments and not errors else None
+		except Exception as e:
+			with lock:
+				errors.append( e )
+
+	# Returns the end of the segment starting at start, taking it for the stream d, if it is still free
+	def follow( start ):
+		with lock:
+			if segments and not errors and segments[0][0] == start:
+				return segments.popleft()[1]
+		return None
+
+	threads = []
+	try:
+		for i in range( extra ):
+			with lock:
+				if not segments:
+					break
+				segment = segments.pop()
+			t = threading.Thread( target=work, args=( None, segment ) )
+			t.daemon = True
+			t.start()
+			threads.append( t )
+		work( d, first )
+		with tracing.tracer.span( 'segment_wait' ):
+			for t in threads:
+				t.join()
+	finally:
+		releaseSegmentConnections( url, extra )
+	if errors:
+		if os.path.isfile( part_fp ):
+			os.remove( part_fp )
+		raise errors[0]
+
+	with open( part_fp, 'r+b' ) as f:
+		if hasher is not None or extractor is not None:
+			with tracing.tracer.span( 'hashing', url=url ) as span:
+				for chunk in iter( lambda: f.read( dl_chunk_size ), '' ):
+					if hasher is not None:
+						hasher.update( chunk )
+					span.lap()
+					if extractor is not None:
+						extractor.update( chunk )
+						span.lap( 'extraction' )
+		with tracing.tracer.span( 'disk_sync' ):
+			partFiles.sync( f )
+	printIfVerbose( "Finished." )
+	return True
+
+# Downloads bytes start to end (inclusive) of url into the file at fp, which must already be at least end + 1 bytes long. If d is passed, it is a stream already positioned at start. A stalled stream is restarted from where it got to, up to dl_att_thshold times. Gives up early if anything turns up in errors (the failures of the other segments).
+# If follow is passed, and d runs on to the end of the file, then once end is reached follow( end + 1 ) is asked for the end of the next segment to carry straight on into. It returns None once there is nothing more to read. A stream restarted after stalling only covers up to end, so isn't carried on.
+def dlSegment( url, fp, start, end, validator, d=None, errors=(), follow=None ):
+	labels = { 'host': downloadPool.getHost( url ) }
+	num_att = 1
+	while True:
+		try:
+			opened = d is None # The stream we were handed is already counted in the metrics by dlFile
+			if opened:
+				if request_spacer is not None:
+					with tracing.tracer.span( 'request_spacing' ):
+						time.sleep( request_spacer.book( labels['host'] ) )
+				d = openDownloadStream( url, start, validator, end )
+				if d.getcode() != 206:
+					d.close()
+					raise SegmentedDownloadException( "%s stopped honouring range requests, or the file changed" % url )
+				metrics.registry.add( 'download_active_connections', 1, labels )
+			try:
+				watchdog = StreamWatchdog( end - start + 1 )
+				with open( fp, 'r+b', write_buffer_size ) as f, tracing.tracer.span( 'transfer', url=url, offset=start ) as span:
+					f.seek( start )
+					while True:
+						if start > end:
+							end = follow( start ) if follow is not None and not opened else None
+							if end is None:
+								break
+						if errors:
+							return
+						chunk = d.read( min( dl_chunk_size, end - start + 1 ) )
+						span.lap()
+						if not chunk:
+							raise urllib.ContentTooShortError( "segment of %s ended %s bytes early" % ( url, end - start + 1 ), None )
+						f.write( chunk )
+						span.lap( 'disk_write' )
+						start += len( chunk )
+						metrics.registry.mark( 'download_bytes_total', 'download_bytes_per_second', len( chunk ), labels )
+						if bandwidth_limiter is not None:
+							bandwidth_limiter.consume( labels['host'], len( chunk ) )
+							span.lap( 'throttle' )
+						watchdog.update( len( chunk ) )
+				return
+			finally:
+				d.close()
+				d = None
+				if opened:
+					metrics.registry.add( 'download_active_connections', -1, labels )
+		except ( DownloadStreamStalledException, socket.timeout ) as e:
+			num_att += 1
+			if dl_att_thshold != -1 and num_att > dl_att_thshold:
+				raise DownloadStreamDeadException( "Segment of %s died and could not be restarted." % url )
+			printIfVerbose( "Segment of %s seems dead (%s). Resuming from byte %s" % ( url, e, start ) )
+			reason = 'stalled' if isinstance( e, DownloadStreamStalledException ) else 'timeout'
+			metrics.registry.inc( 'download_restarts_total', { 'host': labels['host'], 'reason': reason } )
+			with tracing.tracer.span( 'restart_wait' ):
+				time.sleep( restart_wait_time )
+
 def getFileSizeOnServer( url ):
 	d = urllib.urlopen( url )
 	size = int( d.info()['Content-Length'] )
@@ -90,110 +504,243 @@ def getFileSizeOnServer( url ):
 		
 # Returns true if the file at fp and the file at url are the same size on disk.
 # The percentage of the file that has to be present for it to be considered 'complete' can be altered by changing dl_completion_threshold
+# The size of the file at url is taken from the metadata index, which was filled in when the file was downloaded. Only if the file isn't in the index is the server asked for it.
 def downloadComplete( url, fp ):
-	size_on_server = getFileSizeOnServer( url )
+	size_on_server = getRecordedSize( url, fp )
+	if size_on_server is None:
+		size_on_server = getFileSizeOnServer( url )
 	size_on_disk = os.path.getsize( fp )
 	if size_on_disk >= size_on_server:
 		return True
 	return False
 	
+# Returns the size the server gave for url when it was downloaded to fp, or None if we don't have one. When there's a download journal, it is the only record of what we know about each url, the same one downloadWrapper's completeness check goes by. The metadata index is only for downloads with no journal.
+def getRecordedSize( url, fp ):
+	if download_journal is not None:
+		entry = download_journal.getEntry( url )
+		return entry['expected_size'] if entry is not None else None
+	record = metadataIndex.getIndex( outputLayout.getDownloadDir( fp ) ).get( os.path.basename( fp ) )
+	if record is not None and record['url'] == url:
+		return record['size']
+	return None
+
 # You can pass a postfix in through post which will be affixed to the end of the filename, before the file extension. Useful if you're downloading multiple files which all have the same output name (AutoGrid, a website we use a lot, does this), and want to distinguish between them 
-def dlFileWithProcChecks( url, f_path, post='' ):
+# The download stream is read in this process and watched as it goes (see StreamWatchdog). If it dies, the download is picked back up (or restarted) up to dl_att_thshold times.
+# The file only appears at f_path once it is complete and has passed its checks, so a file at f_path can always be trusted (see partFiles.py).
+# If a server_info dict is passed, it is filled in with what the server told us about the file (see getResponseInfo).
+def dlFileWithStreamChecks( url, f_path, post='', server_info=None ):
+	extractor = None
 	try:
 		# Fist we check if the file already exists.
 		if os.path.isfile( f_path ):
 			printIfVerbose(  "%s already present on disk." % f_path )
 			if checkDownloadCompleteness == True:
-				if downloadComplete( url, f_path ):
+				with tracing.tracer.span( 'completeness_check', url=url ):
+					complete = downloadComplete( url, f_path )
+				if complete:
 					printIfVerbose( "Download of file is complete." )
 					return True
 				else:
 					printIfVerbose( "Download incomplete. Overwriting existing file with fresh download attempt." )
+					os.remove( f_path )
+					outputLayout.getLayout( outputLayout.getDownloadDir( f_path ) ).remove( f_path )
 			else:
 				return True
 		
-		# Start the file download as a child process who's progress we can check on to determine the health of the stream
-		p = proc( target=dlFile, args=( url, f_path ) )
-		p.start()
-		
-		file_size = 0 # We initialize the recorded size of the file to 0 bytes.
-		server_size = getFileSizeOnServer(url)
+		if server_info is None:
+			server_info = {} # Filled in by dlFile from the download response
+		offset = 0
+		validator = None
+		listed_checksums = {} # The checksum for this file from the checksum list, if we have one
+		if checksum_list_fp is not None and os.path.basename( f_path ) in integrity.loadChecksumList( checksum_list_fp ):
+			algorithm, checksum = integrity.loadChecksumList( checksum_list_fp )[os.path.basename( f_path )]
+			listed_checksums[algorithm] = checksum
+		algorithms = listed_checksums.keys()
+		if digest_algorithm is not None:
+			algorithms.append( digest_algorithm )
+		hasher = integrity.StreamHasher( algorithms )
+		dl_dir = outputLayout.getDownloadDir( f_path ) # Not necessarily the directory the file is in. See outputLayout.py.
+		if extract_dir is not None and os.path.splitext( f_path )[1] == '.gz':
+			extractor = extraction.StreamExtractor( extraction.getExtractedPath( f_path, extract_dir ) )
 		num_att = 1 # Intitialize the number of attempts at downloading the file we have made.
-		dead_cycles = 0 # Initialize the variable for how many cycles the link has been dead for.
-		
-		while p.is_alive():
-			p.join( proc_check_time )
-			
-			# During the first iteration of this loop, if the proc_check_time is short enough, execution may reach this line before the subprocess has managed to create the file. To allow for this, we simply wait until the file is created. 
-			wait_for_file_creation_count = 0
-			while not os.path.exists( f_path ):
-				# We can only wait so long until we should assume that some error has occurred in creating the file.
-				if wait_for_file_creation_count > file_creation_wait_limit:
-					raise FileNotCreatedException( "Target file for %s at %s was not created" % ( url, f_path ) )
-				time.sleep( 1 )
-				wait_for_file_creation_count += 1
-				
-			# Once execution reaches this point, we know that the file has been created.
-			# We need to check in on p until it returns, and therefore is no longer 'alive'
-			if p.is_alive():
-				printIfVerbose( "Checking download stream health..." )
-				# Get the current size of the file in bytes
-				curr_size = os.path.getsize( f_path )
-				growth = curr_size - file_size
-				printIfVerbose( "Prv size: %s - Curr size: %s/%s - DL Rate: %s B/s" % ( file_size, curr_size, server_size, float( growth / proc_check_time ) ) )
-				if curr_size > file_size:
-					printIfVerbose( "Download stream seems healthy." )
-					file_size = curr_size
-					dead_cycles = 0
-				elif curr_size <= file_size:
-					printIfVerbose( "Download stream not looking so healthy." )
-					dead_cycles += 1
-					if dead_cycles > max_dead_cycles:
-						# If the file size has not changed for max_dead_cycles cycles, the stream is likely dead. 
-						# We will kill the download and restart it. Hopefully this will solve the problem
-						printIfVerbose( "Download stream seems dead. Restart attempt #%s" % num_att )
-						num_att += 1 # Keep track of the number of times we've tried to download this file
-						# If we have already tried to restart this download the maximum number of times allowed, log the error and move on.
-						if num_att > dl_att_thshold:
-							p.terminate()
-							p.join()
-							os.remove( f_path )
-							raise DownloadStreamDeadException( "Download stream for %s died and could not be restarted." % url )
-						p = restartDL( p, f_path, url )
-						file_size = 0
+		while True:
+			try:
+				dlFile( url, f_path, offset, validator, server_info, hasher, extractor )
+				break
+			except ( DownloadStreamStalledException, socket.timeout ) as e:
+				printIfVerbose( "Download stream seems dead (%s). Restart attempt #%s" % ( e, num_att ) )
+				reason = 'stalled' if isinstance( e, DownloadStreamStalledException ) else 'timeout'
+				metrics.registry.inc( 'download_restarts_total', { 'host': downloadPool.getHost( url ), 'reason': reason } )
+				num_att += 1 # Keep track of the number of times we've tried to download this file
+				# If we have already tried to restart this download the maximum number of times allowed, log the error and move on.
+				if dl_att_thshold != -1 and num_att > dl_att_thshold:
+					raise DownloadStreamDeadException( "Download stream for %s died and could not be restarted." % url )
+				with tracing.tracer.span( 'restart_wait' ):
+					time.sleep( restart_wait_time )
+				offset, validator = getResumePoint( f_path, server_info )
+				if offset > 0:
+					printIfVerbose( "Resuming download of %s from byte %s" % ( url, offset ) )
+
+		# The file has been hashed on its way to the disk, so checking it costs nothing more than a comparison
+		digests = hasher.hexdigests()
+		try:
+			with tracing.tracer.span( 'verify' ):
+				integrity.verify( digests, server_info.get( 'checksums', {} ), f_path )
+				integrity.verify( digests, listed_checksums, f_path )
+		except integrity.ChecksumMismatchException:
+			partFiles.discard( f_path )
+			raise
+		if extractor is not None:
+			with tracing.tracer.span( 'extraction' ):
+				extracted = extractor.finish()
+			if not extracted:
+				# Most likely the server sent something other than a .gz file. That's no reason to throw the download away, so keep it without its extracted copy, and note why.
+				printIfVerbose( "Could not extract %s (%s). Keeping the download as it is." % ( getNameFromURL( url ), extractor.error ) )
+				with open( getErrorLogPath( f_path ), 'a' ) as log:
+					log.write( "Could not extract %s from %s: %s\n" % ( os.path.basename( f_path ), url, extractor.error ) )
+		with tracing.tracer.span( 'commit' ):
+			partFiles.commit( partFiles.getPartPath( f_path ), f_path )
+
+		with tracing.tracer.span( 'record' ):
+			if digest_algorithm is not None:
+				server_info['digest'] = "%s:%s" % ( digest_algorithm, digests[digest_algorithm] )
+				integrity.getManifest( dl_dir, digest_algorithm ).record( os.path.basename( f_path ), digests[digest_algorithm] )
+
+			# Keep what the server told us about the file, and where we put it, so that nobody needs to ask the server or search the disk again. If there's a journal, it keeps the server's side of things (see dlFileAndRecord).
+			if download_journal is None:
+				metadataIndex.getIndex( dl_dir ).record( os.path.basename( f_path ), url, server_info )
+			outputLayout.getLayout( dl_dir ).record( os.path.basename( f_path ), f_path )
 
 	except Exception as e:
+		if extractor is not None:
+			extractor.abort()
+		if server_info is not None and isinstance( e, urllib2.HTTPError ):
+			server_info['status'] = e.code # Whether there's any point trying again depends on it (see backoff.py)
 		printIfVerbose(  "Error encountered while downloading %s. Logging event and skipping file." % getNameFromURL( url ) )
-		dir, file = os.path.split( f_path )
-		name = file.split( '.' )[0]
-		err_log_dir = os.path.join( dir, 'error_logs' )
-		if not os.path.isdir( err_log_dir ):
-			os.mkdir( err_log_dir )
-		err_log_fp = os.path.join( err_log_dir, name + '.txt' )
-		with open( err_log_fp, 'a' ) as log:
+		partFiles.discard( f_path ) # Nothing to pick back up from next time, since the next attempt starts from scratch
+		name = os.path.basename( f_path ).split( '.' )[0]
+		with open( getErrorLogPath( f_path ), 'a' ) as log:
 			log.write( "Error while downloading %s from %s\n" % ( name, url ) )
 			traceback.print_exc( log )
+		# The caller needs to know about forcibly closed connections so that it can back off the server.
+		if isForcedClose( e ):
+			raise ConnectionForciblyClosedException( "Server closed the connection while downloading %s" % url )
 		return False
 		
 	return True
 
+# Returns the path of the error log for the file at f_path, making the error log directory if need be
+def getErrorLogPath( f_path ):
+	err_log_dir = os.path.join( outputLayout.getDownloadDir( f_path ), 'error_logs' )
+	if not os.path.isdir( err_log_dir ):
+		os.mkdir( err_log_dir )
+	return os.path.join( err_log_dir, os.path.basename( f_path ).split( '.' )[0] + '.txt' )
+
+dlFileWithProcChecks = dlFileWithStreamChecks # The name this function went by back when every download ran in its own process
+
 # Downloads files from a list of urls passed as a parameter
-# list = list of url strings to download
-# dl_dir = the direcectory into which the files will be downloaded
-def dlFilesFromList( list, dl_dir ):
-	kill_flag = False
+# list = list of url strings to download. This can be any iterable (it's only read as far ahead as the downloads need), or a workItems.WorkItems store, in which case every url in it without a result yet is downloaded.
+# dl_dir = the direcectory into which the files will be downloaded. Where in it each file goes is up to outputLayout.scheme.
+# journal = an optional downloadJournal.DownloadJournal, which will be kept up to date with the state of each download as it happens
+# retry = if true (and loop_dl_attempts is on), failed downloads are retried before this returns. Otherwise it's up to the caller to try them again.
+# Up to max_concurrent_downloads files are downloaded at once, but never more than max_conns_per_host from any one server, and never more than one new request to a server every base_wait_time seconds or so.
+# Returns a workItems.WorkItems store of every url, with the result of its download. Each url is added to it as it is read from list, and known only by its id from then on, so that a list of millions of urls never costs more than a few dozen bytes a url. If interrupted (Ctrl+C), the KeyboardInterrupt is passed on to the caller.
+def dlFilesFromList( list, dl_dir, journal=None, retry=True ):
+	global server_controller, download_journal, bandwidth_limiter, request_spacer, download_pool
+	download_journal = journal
+	if adaptive_concurrency == True and server_controller is None:
+		server_controller = serverProfiles.AdaptiveController( server_profiles_fp, max_conns_per_host )
+	if bandwidth_limiter is None and ( host_bandwidth_limit is not None or total_bandwidth_limit is not None ):
+		bandwidth_limiter = politeness.BandwidthLimiter( host_bandwidth_limit, total_bandwidth_limit )
+	if request_spacer is None and base_wait_time > 0:
+		request_spacer = politeness.RequestSpacer( base_wait_time, request_jitter )
+	layout = outputLayout.getLayout( dl_dir )
+	if isinstance( list, workItems.WorkItems ):
+		items = list
+		jobs = ( ( id, layout.prepare( items.name( id ) ) ) for id in items.ids() )
+	else:
+		items = workItems.WorkItems()
+		jobs = ( ( items.add( url ), layout.prepare( url ) ) for url in list )
+	retry_func = None
+	if retry == True and loop_dl_attempts == True:
+		retry_func = lambda id: scheduleRetry( items.url( id ), failure_statuses.pop( items.url( id ), None ) )
+	pool = downloadPool.DownloadPool( lambda id, f_path: dlFileAndWait( items.url( id ), f_path ), max_concurrent_downloads, max_conns_per_host, server_controller, request_spacer, retry_func, items )
+	download_pool = pool
+	metrics.registry.setGaugeFunction( 'download_queue_depth', lambda: pool.num_pending )
 	try:
-		for url in list:
-			dir, file = os.path.split( url )
-			f_path = os.path.join( dl_dir, file )
-			executed = dlFileWithProcChecks( url, f_path )
-			if kill_flag:
-				sys.exit()
-			if executed == True:
-				# Wait a random amount of seconds. I guess some servers will kick you off if you don't wait at all between downloads, and still others will kick you off if you wait exactly the same amount of time between downloads. I've never seen it, but I've read about it and its easy enough to implement.
-				factor = random.random() + .5 # Returns a random decimal value between .5 and 1.5
-				wait_time = base_wait_time * factor
-				printIfVerbose(  "Sleeping for %s seconds..." % wait_time )
+		return pool.run( jobs )
 	except KeyboardInterrupt:
-		kill_flag = True
+		# Passed on rather than returned, so that the caller stops too instead of starting on its next batch. Downloads that were cut off are left in flight, and started again from scratch the next time the journal is opened.
+		printIfVerbose( "Download interrupted." )
+		raise
+	finally:
+		failure_statuses.clear() # Those that weren't retried
+		if server_controller is not None:
+			server_controller.save()
 
+# Decides whether, and when, a failed download gets another go. Returns the number of seconds to wait before retrying url, or None if it has failed too many times, or with an HTTP status (passed as status) that means it never will download. In that case it is quarantined, so that it stops taking up connections.
+def scheduleRetry( url, status=None ):
+	if download_journal is not None:
+		attempts = download_journal.getAttempts( url )
+	else:
+		attempts = failed_attempts[url] = failed_attempts.get( url, 0 ) + 1
+	delay = backoff.retryDelay( attempts, status )
+	if delay is None:
+		if backoff.isPermanent( status ):
+			printIfVerbose( "The server answered HTTP %s for %s. Quarantining it." % ( status, url ) )
+		else:
+			printIfVerbose( "Giving up on %s after %s attempts. Quarantining it." % ( url, attempts ) )
+		metrics.registry.recordQuarantine( downloadPool.getHost( url ) )
+		if download_journal is not None:
+			download_journal.markQuarantined( url )
+		return None
+	printIfVerbose( "Will try %s again in %d seconds." % ( url, delay ) )
+	if download_journal is not None:
+		download_journal.setRetryTime( url, time.time() + delay )
+	return delay
+
+# Downloads a single file for the download pool, as one span of the trace if tracing is on (see tracing.py).
+# The name dates from when this is where the pause between downloads happened. The pool now sees to that (see politeness.RequestSpacer), without tying up a worker.
+def dlFileAndWait( url, f_path ):
+	with tracing.tracer.span( 'download', url=url ) as span:
+		executed = dlFileAndRecord( url, f_path )
+		span.set( 'result', executed )
+		return executed
+
+# Downloads a single file, and keeps the journal, the server controller and the metrics up to date with how it went.
+def dlFileAndRecord( url, f_path ):
+	host = downloadPool.getHost( url )
+	# A file that is already on disk never touches the server, so it tells us nothing about the server's tolerance.
+	already_present = os.path.isfile( f_path )
+	server_info = {}
+	if download_journal is not None:
+		with tracing.tracer.span( 'journal' ):
+			download_journal.markInFlight( url )
+	try:
+		executed = dlFileWithStreamChecks( url, f_path, server_info=server_info )
+	except ConnectionForciblyClosedException:
+		printIfVerbose( "%s forcibly closed our connection. Backing off." % host )
+		if server_controller is not None:
+			server_controller.recordForcedClose( host )
+		metrics.registry.inc( 'download_failures_total', { 'host': host, 'reason': 'forced_close' } )
+		if download_journal is not None:
+			with tracing.tracer.span( 'journal' ):
+				download_journal.markFailed( url, server_info.get( 'size' ) )
+		return False
+	if executed == True and 'size' in server_info:
+		metrics.registry.recordCompletion( host )
+	elif executed == True:
+		metrics.registry.recordSkip( host ) # The file was already on disk, so the server never sent us anything (see getResponseInfo)
+	else:
+		metrics.registry.inc( 'download_failures_total', { 'host': host, 'reason': 'error' } )
+		if server_info.get( 'status' ) is not None:
+			failure_statuses[url] = server_info['status']
+	if download_journal is not None:
+		with tracing.tracer.span( 'journal' ):
+			if executed == True:
+				download_journal.markDone( url, server_info.get( 'size' ), server_info.get( 'digest' ), etag=server_info.get( 'etag' ), last_modified=server_info.get( 'last_modified' ) )
+			else:
+				download_journal.markFailed( url, server_info.get( 'size' ) )
+	if executed == True and not already_present and server_controller is not None:
+		server_controller.recordSuccess( host )
+	return executed
@@ -0,0 +1,29 @@
+"""
+How long to wait before trying a failed download again, and when to stop trying.
+
+Each failure doubles the wait before the next attempt, up to retry_max_delay, and the wait is varied at random so that a batch of urls that failed together (say, when the server threw us off) doesn't come back all at once. Once a url has been tried max_attempts times it is quarantined: it is left alone from then on, so that it stops taking up connections that could be going to urls that will actually download. Quarantined urls can be put back in line with downloadWrapper.main_release_quarantine.
+
+Not every failure is worth waiting out, though. A url the server answers with a 4xx status (not found, gone, forbidden etc.) will get the same answer however often it's asked, so it is quarantined straight away. The exceptions are 408 and 429, where the server is only telling us to come back later. Connection errors, 5xx statuses and forced closes all get the usual backoff.
+"""
+import random
+
+retry_base_delay = 60  # The number of seconds to wait before retrying a url that has failed once
+retry_max_delay = 60 * 60  # The longest we'll ever wait between attempts, in seconds
+retry_jitter = 0.5  # How far either way of the computed delay the actual delay can vary, as a fraction of it
+max_attempts = 8  # The number of attempts after which a url is quarantined
+transient_client_statuses = (408, 429)  # The 4xx statuses that are worth trying again after (request timeout, too many requests)
+
+
+# Returns True if the HTTP status a failed attempt got (None if it didn't get one) means the url will never download,
+# however often it's tried
+def isPermanent(status):
+    return status is not None and 400 <= status < 500 and status not in transient_client_statuses
+
+
+# Returns the number of seconds to wait before making attempt number attempts + 1 at a url, or None if it has had
+# max_attempts already, or its last attempt failed with a permanent HTTP status, and should be quarantined.
+def retryDelay(attempts, status=None):
+    if attempts >= max_attempts or isPermanent(status):
+        return None
+    delay = min(retry_max_delay, retry_base_delay * 2 ** max(0, attempts - 1))
+    return delay * random.uniform(1 - retry_jitter, 1 + retry_jitter)
@@ -0,0 +1,208 @@
+"""
+Throughput benchmark for the downloader, run against the flaky stand-in server (see flakyServer.py) rather than the real one.
+
+Each scenario starts a fresh flaky server set up to misbehave in one particular way, and downloads all of its files into a fresh directory, once with MassDownloader.dlFilesFromList (with no journal) and once with downloadWrapper.main (with a journal, ordering and all, the way a real run does). For each run it reports:
+    files    The number of files that made it to disk intact, out of the number the server has
+    corrupt  The number of files that made it to disk with the wrong contents
+    files/s  Intact files per second
+    KB/s     Bytes of intact files per second
+    wasted   Bytes the server sent that didn't end up in an intact file (partial downloads that were thrown away, etc.)
+    recover  The average and longest time, in seconds, from the server making trouble to the next download getting through
+
+Every run uses the same engine_settings, so that the numbers for different versions of the downloader can be compared. To run only some of the scenarios, name them on the command line:
+    python benchmark.py clean resets
+"""
+import hashlib
+import json
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+
+import MassDownloader as md
+import backoff
+import flakyServer
+import outputLayout
+import tracing
+
+# Every scenario is run with these files
+base_settings = {'num_files': 40, 'file_size': 256 * 1024}
+
+# (name, flaky server settings). Anything not given here is left as in flakyServer.default_settings.
+scenarios = [
+    ('clean', {}),
+    ('connection_limit', {'max_concurrent': 1, 'ban_time': 10, 'throttle_rate': 512 * 1024}),  # Throttled so that downloads last long enough to overlap
+    ('stalls', {'stall_probability': 0.1, 'stall_time': 30}),
+    ('throttled', {'throttle_rate': 128 * 1024}),
+    ('wrong_length', {'wrong_length_probability': 0.1}),
+    ('resets', {'reset_probability': 0.1}),
+    ('everything', {'max_concurrent': 2, 'ban_time': 10, 'stall_probability': 0.05, 'stall_time': 30,
+                    'throttle_rate': 256 * 1024, 'wrong_length_probability': 0.05, 'reset_probability': 0.05}),
+]
+
+entry_points = ('dlFilesFromList', 'main')  # The ways each scenario is downloaded
+
+# MassDownloader settings used for every run. The pause between downloads and the restart wait are cut down so that
+# the benchmark finishes in minutes rather than hours, and would otherwise drown out everything being measured.
+engine_settings = {
+    'base_wait_time': 0,
+    'restart_wait_time': 1,
+    'read_timeout': 5,
+    'stall_window': 5,
+    'verbose': False,
+}
+
+# Retry settings (see backoff.py) used for every run, cut down for the same reason
+backoff_settings = {
+    'retry_base_delay': 1,
+    'retry_max_delay': 10,
+}
+
+results_fp = None  # If set, the results are also written to this file as JSON
+trace_dir = None  # If set, every run is traced (see tracing.py), and its trace written to this directory as SCENARIO_ENTRYPOINT.json
+
+verbose = True
+
+
+def printIfVerbose(message):
+    if verbose == True:
+        print(message)
+
+
+# Returns the number of files in dl_dir that match what the server has, the number that don't, and the number of bytes
+# in the ones that do
+def checkDownloads(server, dl_dir):
+    settings = server.settings
+    intact = corrupt = intact_bytes = 0
+    layout = outputLayout.getLayout(dl_dir)
+    for name in server.files:
+        fp = layout.getPath(name)
+        if not os.path.isfile(fp):
+            continue
+        h = hashlib.sha256()
+        with open(fp, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), ''):
+                h.update(chunk)
+        if os.path.getsize(fp) == settings['file_size'] and h.hexdigest() == flakyServer.fileDigest(name, settings['file_size'], settings['seed']):
+            intact += 1
+            intact_bytes += settings['file_size']
+        else:
+            corrupt += 1
+    return intact, corrupt, intact_bytes
+
+
+def runDlFilesFromList(server, work_dir):
+    dl_dir = os.path.join(work_dir, 'downloads')
+    os.makedirs(dl_dir)
+    md.dlFilesFromList(server.urls(), dl_dir)
+    return dl_dir
+
+
+def runMain(server, work_dir):
+    # downloadWrapper sets itself up in the working directory as soon as it is imported
+    old_cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        import downloadWrapper
+        wrapper_settings = {
+            'DOWNLOAD_DIRECTORY': os.path.join(work_dir, 'downloads'),
+            'url_list_directory': os.path.join(work_dir, 'urls'),
+            'completeness_reports_directory': os.path.join(work_dir, 'reports'),
+            'JOURNAL_FP': os.path.join(work_dir, 'download_journal.sqlite'),
+            'METRICS_PORT': None,
+            'METRICS_SNAPSHOT_FP': None,
+            'verbose': False,
+        }
+        for name, value in wrapper_settings.items():
+            setattr(downloadWrapper, name, value)
+        for dir in (downloadWrapper.DOWNLOAD_DIRECTORY, downloadWrapper.url_list_directory, downloadWrapper.completeness_reports_directory):
+            if not os.path.isdir(dir):
+                os.makedirs(dir)
+        with open(os.path.join(downloadWrapper.url_list_directory, 'urls.txt'), 'w') as f:
+            f.writelines("%s\n" % url for url in server.urls())
+        downloadWrapper.main()
+        return downloadWrapper.DOWNLOAD_DIRECTORY
+    finally:
+        os.chdir(old_cwd)
+
+
+runners = {'dlFilesFromList': runDlFilesFromList, 'main': runMain}
+
+
+# Downloads every file of a fresh flaky server with the given settings, using entry_point, and returns what happened
+def runScenario(name, settings, entry_point):
+    server_settings = dict(base_settings)
+    server_settings.update(settings)
+    server = flakyServer.start(server_settings)
+    work_dir = tempfile.mkdtemp(prefix='benchmark_')
+    for setting, value in engine_settings.items():
+        setattr(md, setting, value)
+    for setting, value in backoff_settings.items():
+        setattr(backoff, setting, value)
+    md.failed_attempts.clear()
+    md.server_profiles_fp = os.path.join(work_dir, 'server_profiles.json')  # Every run starts out knowing nothing about the server
+    md.server_controller = None
+    if trace_dir is not None:
+        tracing.start()
+    try:
+        start_time = time.time()
+        dl_dir = runners[entry_point](server, work_dir)
+        elapsed = time.time() - start_time
+        intact, corrupt, intact_bytes = checkDownloads(server, dl_dir)
+    finally:
+        if trace_dir is not None:
+            tracing.stop()
+            tracing.tracer.writeChromeTrace(os.path.join(trace_dir, '%s_%s.json' % (name, entry_point)))
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    stats = server.stats()
+    recoveries = stats['recoveries']
+    return {
+        'scenario': name,
+        'entry_point': entry_point,
+        'files': intact,
+        'total_files': len(server.files),
+        'corrupt': corrupt,
+        'elapsed': elapsed,
+        'files_per_second': intact / elapsed,
+        'bytes_per_second': intact_bytes / elapsed,
+        'wasted_bytes': max(0, stats['bytes_sent'] - intact_bytes),
+        'mean_recovery': sum(recoveries) / len(recoveries) if recoveries else None,
+        'max_recovery': max(recoveries) if recoveries else None,
+        'unrecovered': stats['unrecovered_since'] is not None,
+        'server': stats,
+    }
+
+
+def formatResult(r):
+    if r['mean_recovery'] is None:
+        recovery = '-'
+    else:
+        recovery = "%.1f/%.1f" % (r['mean_recovery'], r['max_recovery'])
+    if r['unrecovered']:
+        recovery += ' (never)'
+    return "%-17s %-16s %5s/%-4s %7s %8.2f %9.1f %10s %12s" % (
+        r['scenario'], r['entry_point'], r['files'], r['total_files'], r['corrupt'], r['files_per_second'],
+        r['bytes_per_second'] / 1024, r['wasted_bytes'], recovery)
+
+
+def main(names=None):
+    chosen = [(name, settings) for name, settings in scenarios if not names or name in names]
+    printIfVerbose("%-17s %-16s %10s %7s %8s %9s %10s %12s" % ('scenario', 'entry point', 'files', 'corrupt', 'files/s', 'KB/s', 'wasted', 'recover'))
+    results = []
+    for name, settings in chosen:
+        for entry_point in entry_points:
+            result = runScenario(name, settings, entry_point)
+            results.append(result)
+            printIfVerbose(formatResult(result))
+    if results_fp is not None:
+        with open(results_fp, 'w') as f:
+            json.dump(results, f, indent=1)
+    return results
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
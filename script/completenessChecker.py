@@ -0,0 +1,165 @@
+"""
+Checks downloaded files for completeness against the copies on the server, as cheaply as the server allows.
+
+Each check is a HEAD request, so the server never sends a body we would just throw away. The requests are spread over a pool of worker threads (see downloadPool.py) so that several servers can be checked at once without any single server seeing more than its share of connections. Connections are kept open between requests rather than opened anew for each file, in a pool for each server shared by all the workers, so there are never more connections open to a server than there are checks running against it.
+
+If we already know a file's ETag or Last-Modified date, the request is made conditional. A server with an unchanged file answers with an empty 304, and the file is judged against the size we recorded for it earlier.
+"""
+import httplib
+import os.path
+import socket
+import threading
+import urlparse
+
+import downloadPool
+import tracing
+import workItems
+
+check_timeout = 30  # The number of seconds to wait on a server's response before giving up on a check.
+max_redirects = 5  # The number of redirects that will be followed for a single check.
+
+max_idle_per_host = 2  # The most connections to any one server kept open between requests. Set by checkFiles to its per_host_limit.
+
+_idle = {}  # (scheme, host) -> connections not in use at the moment, shared by every worker thread
+_idle_lock = threading.Lock()
+
+
+class CheckFailedException(Exception):
+    pass
+
+
+# Takes an idle connection to the server out of the pool, or opens a new one if there aren't any (or fresh is set)
+def _getConnection(scheme, netloc, fresh=False):
+    with _idle_lock:
+        idle = _idle.get((scheme, netloc))
+        if idle and not fresh:
+            return idle.pop()
+    if scheme == 'https':
+        return httplib.HTTPSConnection(netloc, timeout=check_timeout)
+    return httplib.HTTPConnection(netloc, timeout=check_timeout)
+
+
+# Puts a connection we're done with back in the pool, unless the pool for its server is full
+def _releaseConnection(scheme, netloc, conn):
+    with _idle_lock:
+        idle = _idle.setdefault((scheme, netloc), [])
+        if len(idle) < max_idle_per_host:
+            idle.append(conn)
+            return
+    conn.close()
+
+
+# Closes every idle connection
+def closeConnections():
+    with _idle_lock:
+        conns = [conn for idle in _idle.values() for conn in idle]
+        _idle.clear()
+    for conn in conns:
+        conn.close()
+
+
+# Sends a HEAD request for url over a kept-alive connection, following redirects. Returns (status, headers), with the
+# header names in lower case.
+def headRequest(url, headers=None):
+    for i in range(max_redirects + 1):
+        parts = urlparse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        # A connection that has sat idle may have been closed by the server without our knowing. That only shows up
+        # when we try to use it, so give it one more go on a fresh connection.
+        for attempt in (1, 2):
+            conn = _getConnection(parts.scheme, parts.netloc, fresh=attempt == 2)
+            try:
+                with tracing.tracer.span('request', url=url):
+                    conn.request('HEAD', path, headers=headers or {})
+                    resp = conn.getresponse()
+                    resp.read()
+                break
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if attempt == 2:
+                    raise
+        resp_headers = dict(resp.getheaders())
+        if resp.will_close:
+            conn.close()
+        else:
+            _releaseConnection(parts.scheme, parts.netloc, conn)
+        if resp.status in (301, 302, 303, 307, 308) and 'location' in resp_headers:
+            url = urlparse.urljoin(url, resp_headers['location'])
+            continue
+        return (resp.status, resp_headers)
+    raise CheckFailedException("Too many redirects checking %s" % url)
+
+
+# Checks a single downloaded file. param is a dict with the file's 'url' and path 'fp', and optionally the
+# 'expected_size', 'etag' and 'last_modified' we recorded for it earlier.
+# Returns a dict with whether the file is 'complete', and the 'size', 'etag' and 'last_modified' the server has for it.
+def checkFile(param):
+    url = param['url']
+    if not os.path.isfile(param['fp']):
+        return {'complete': False, 'size': None, 'etag': None, 'last_modified': None}
+    size_on_disk = os.path.getsize(param['fp'])
+    expected_size = param.get('expected_size')
+
+    headers = {}
+    if expected_size is not None:
+        # A 304 doesn't carry a size, so there's no point in asking for one unless we already know the size
+        if param.get('etag'):
+            headers['If-None-Match'] = param['etag']
+        if param.get('last_modified'):
+            headers['If-Modified-Since'] = param['last_modified']
+
+    status, resp_headers = headRequest(url, headers)
+    if status == 304:
+        return {'complete': size_on_disk >= expected_size, 'size': expected_size,
+                'etag': param.get('etag'), 'last_modified': param.get('last_modified')}
+    if status != 200 or 'content-length' not in resp_headers:
+        raise CheckFailedException("Could not get the size of %s from the server (HTTP %s)" % (url, status))
+    size_on_server = int(resp_headers['content-length'])
+    return {'complete': size_on_disk >= size_on_server, 'size': size_on_server,
+            'etag': resp_headers.get('etag'), 'last_modified': resp_headers.get('last-modified')}
+
+
+def _checkJob(param):
+    try:
+        with tracing.tracer.span('check', url=param['url']):
+            return checkFile(param)
+    except (CheckFailedException, httplib.HTTPException, socket.error, IOError):
+        return None
+
+
+# Checks every file described in params (see checkFile) and returns a dict mapping each url to the result of its check,
+# or to None if the file couldn't be checked (the server was unreachable, say).
+# At most max_workers checks are run at once, and at most per_host_limit against any one server. The connections are all
+# closed again before this returns.
+def checkFiles(params, max_workers, per_host_limit, controller=None):
+    results = {}
+
+    def report(param, result):
+        results[param['url']] = result
+
+    checkItems(workItems.fromURLs(p['url'] for p in params), lambda id: params[id], report, max_workers, per_host_limit,
+               controller)
+    return results
+
+
+# checkFiles for a workItems.WorkItems store of urls, for when there are too many files to hold a param for each at once.
+# The param for each url (see checkFile) is only built, by getParam(id), as its check starts, and report(param, result)
+# is called with the result as soon as the check is done (from the worker thread that ran it). Whether each file is
+# complete is also recorded in items, as its result.
+def checkItems(items, getParam, report, max_workers, per_host_limit, controller=None):
+    global max_idle_per_host
+    max_idle_per_host = per_host_limit
+
+    def job(id, f_path):
+        param = getParam(id)
+        result = _checkJob(param)
+        report(param, result)
+        return result is not None and result['complete']
+
+    pool = downloadPool.DownloadPool(job, max_workers, per_host_limit, controller, items=items)
+    try:
+        return pool.run((id, None) for id in xrange(len(items)))
+    finally:
+        closeConnections()
@@ -0,0 +1,213 @@
+"""
+Hands out urls to any number of downloadWrapper workers, so that urls no longer need to be split between machines by hand.
+
+The coordinator is a small HTTP server that keeps its own download journal (see downloadJournal.py), filled from its own url directory. Workers ask it for a batch of urls, and each batch is leased to the worker that asked for a limited time. While a worker holds a lease nobody else is given those urls, and the worker keeps renewing its lease for as long as it is working on the batch. When the worker is done it reports which urls it got and which it didn't. If a worker goes offline its leases simply run out, and the urls are handed to the next worker that asks.
+
+To run a coordinator, put the url text files in the 'urls' directory next to it and run this script. Then set COORDINATOR_URL in downloadWrapper.py on each worker to point at it.
+
+Requests and responses are all JSON:
+    POST /lease     {"worker": id, "count": n}              -> {"urls": [...], "lease_time": seconds}
+    POST /renew     {"worker": id, "urls": [...]}           -> {"renewed": n}
+    POST /complete  {"worker": id, "results": {url: bool}}  -> {"recorded": n}   (results for urls the worker no longer holds the lease on are ignored)
+    GET  /status                                            -> {state: number of urls in that state, ..., "outstanding": n}
+"""
+import BaseHTTPServer
+import SocketServer
+import json
+import os
+import os.path
+import socket
+import threading
+import time
+import urllib2
+
+import backoff
+import downloadJournal
+import urlIngest
+
+cwd = os.getcwd()
+COORDINATOR_PORT = 8750  # The port the coordinator listens on
+COORDINATOR_JOURNAL_FP = os.path.join(cwd, 'coordinator_journal.sqlite')
+url_list_directory = os.path.join(cwd, 'urls')
+
+lease_time = 300  # The number of seconds a worker holds a lease for before it has to renew it
+max_batch_size = 100  # The most urls a single worker is given at once
+ingest_interval = 60  # The number of seconds between checks of the url directory for new urls
+request_timeout = 30  # The number of seconds a worker will wait on the coordinator before giving up on a request
+
+verbose = True
+
+
+def printIfVerbose(message):
+    if verbose == True:
+        print(message)
+
+
+class CoordinatorServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, journal, url_dir):
+        BaseHTTPServer.HTTPServer.__init__(self, address, CoordinatorHandler)
+        self.journal = journal
+        self.ingester = urlIngest.URLIngester(url_dir, journal)
+        self.ingest_lock = threading.Lock()
+        self.last_ingest = 0
+
+    # Picks up any new urls from the url directory, as long as we haven't looked recently
+    def refresh(self):
+        with self.ingest_lock:
+            if time.time() - self.last_ingest < ingest_interval:
+                return
+            added = self.ingester.ingest()
+            self.last_ingest = time.time()
+            if added > 0:
+                printIfVerbose("Found %s new urls for download." % added)
+
+    def status(self):
+        states = (downloadJournal.PENDING, downloadJournal.IN_FLIGHT, downloadJournal.DONE, downloadJournal.VERIFIED, downloadJournal.FAILED,
+                  downloadJournal.QUARANTINED)
+        status = dict((state, self.journal.count(state)) for state in states)
+        status['outstanding'] = self.journal.count(downloadJournal.PENDING, downloadJournal.IN_FLIGHT, downloadJournal.FAILED)
+        return status
+
+
+class CoordinatorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        printIfVerbose("%s - %s" % (self.client_address[0], format % args))
+
+    def _respond(self, code, body):
+        data = json.dumps(body)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/status':
+            self._respond(200, self.server.status())
+        else:
+            self._respond(404, {'error': 'Unknown path %s' % self.path})
+
+    def do_POST(self):
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.getheader('Content-Length', 0))))
+            worker = request['worker']
+            count = int(request.get('count', 1))  # The number of urls asked for, by /lease
+        except (ValueError, KeyError, TypeError):
+            self._respond(400, {'error': 'Badly formed request'})
+            return
+        journal = self.server.journal
+        if self.path == '/lease':
+            self.server.refresh()
+            urls = journal.leaseURLs(worker, max(0, min(count, max_batch_size)), lease_time)
+            if len(urls) > 0:
+                printIfVerbose("Leased %s urls to %s." % (len(urls), worker))
+            self._respond(200, {'urls': urls, 'lease_time': lease_time})
+        elif self.path == '/renew':
+            self._respond(200, {'renewed': journal.renewLeases(worker, request.get('urls', []), lease_time)})
+        elif self.path == '/complete':
+            recorded = 0
+            for url, result in request.get('results', {}).items():
+                # A worker whose lease ran out may report in after the url has gone to someone else. Its result is stale,
+                # and taking it could send a finished url back to be downloaded again.
+                if not journal.completeLease(worker, url, result == True):
+                    continue
+                recorded += 1
+                if result == True:
+                    continue
+                # Give the url a rest before anyone is handed it again, and give up on it altogether if it keeps failing
+                delay = backoff.retryDelay(journal.getAttempts(url))
+                if delay is None:
+                    journal.markQuarantined(url)
+                else:
+                    journal.setRetryTime(url, time.time() + delay)
+            self._respond(200, {'recorded': recorded})
+        else:
+            self._respond(404, {'error': 'Unknown path %s' % self.path})
+
+
+# The worker's side of the conversation with the coordinator.
+class CoordinatorClient(object):
+    def __init__(self, base_url, worker=None):
+        self.base_url = base_url.rstrip('/')
+        self.worker = worker or "%s-%s" % (socket.gethostname(), os.getpid())
+
+    def _request(self, path, body=None):
+        if body is None:
+            req = urllib2.Request(self.base_url + path)
+        else:
+            body = dict(body, worker=self.worker)
+            req = urllib2.Request(self.base_url + path, json.dumps(body), {'Content-Type': 'application/json'})
+        d = urllib2.urlopen(req, timeout=request_timeout)
+        try:
+            return json.loads(d.read())
+        finally:
+            d.close()
+
+    # Asks for a batch of up to count urls. Returns (urls, the number of seconds they're leased for). An empty list means
+    # there's nothing left that isn't leased to someone else.
+    def lease(self, count):
+        response = self._request('/lease', {'count': count})
+        return (response['urls'], response['lease_time'])
+
+    def renew(self, urls):
+        return self._request('/renew', {'urls': urls})['renewed']
+
+    # results is a dict mapping each url to True if it was downloaded, and False if it wasn't
+    def complete(self, results):
+        return self._request('/complete', {'results': results})['recorded']
+
+    def status(self):
+        return self._request('/status')
+
+    # Starts renewing the lease (of lease_time seconds, as given by lease) on urls in the background, until stop() is
+    # called on the returned LeaseKeeper.
+    def keepLeases(self, urls, lease_time):
+        keeper = LeaseKeeper(self, urls, lease_time)
+        keeper.start()
+        return keeper
+
+
+# Background thread that renews a worker's lease on a batch of urls well before it runs out. lease_time is the one the
+# coordinator gave out, which needn't be the same as ours.
+class LeaseKeeper(threading.Thread):
+    def __init__(self, client, urls, lease_time):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.client = client
+        self.urls = urls
+        self.lease_time = lease_time
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.lease_time / 3.0):
+            try:
+                self.client.renew(self.urls)
+            except (urllib2.URLError, socket.error, ValueError) as e:
+                # Nothing to do but try again next time. If the coordinator stays unreachable, the lease runs out and
+                # the urls will be handed to some other worker.
+                printIfVerbose("Could not renew lease: %s" % e)
+
+    def stop(self):
+        self.stopped.set()
+
+
+def main():
+    for dir in (url_list_directory,):
+        if not os.path.isdir(dir):
+            os.makedirs(dir)
+    journal = downloadJournal.DownloadJournal(COORDINATOR_JOURNAL_FP)
+    server = CoordinatorServer(('', COORDINATOR_PORT), journal, url_list_directory)
+    server.refresh()
+    printIfVerbose("Coordinator listening on port %s. %s urls outstanding." % (COORDINATOR_PORT, server.status()['outstanding']))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    journal.close()
+
+
+if __name__ == '__main__':
+    main()
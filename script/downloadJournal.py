@@ -0,0 +1,294 @@
+"""
+Persistent record of the state of every url we've been asked to download.
+
+Rather than working out what has and hasn't been downloaded by listing the download directory and looking for marker files every time through the main loop, each url gets a row in a small SQLite database. The row records what state the url is in (pending, in flight, done, verified, failed or quarantined), how many times we've tried to download it, when it may next be tried if it failed, and the size and checksum we expect its file to have. Every change is committed as it happens, so the journal picks up right where it left off after one of the frequent reboots.
+"""
+import os
+import os.path
+import sqlite3
+import threading
+import time
+
+import outputLayout
+
+page_size = 1000  # The number of urls fetched from the journal at a time by iterURLs
+
+# The states a url can be in
+PENDING = 'pending'  # Not downloaded yet
+IN_FLIGHT = 'in_flight'  # Being downloaded right now. If we find a url in this state on start up, the download was cut off.
+DONE = 'done'  # Downloaded, but not checked for completeness
+VERIFIED = 'verified'  # Downloaded and checked for completeness
+FAILED = 'failed'  # The last attempt at downloading it failed. It may be tried again once retry_after has passed.
+QUARANTINED = 'quarantined'  # Failed too many times (see backoff.py), and left alone until released with releaseQuarantined
+
+# The orders iterReady can hand out urls in. Urls whose size we don't know yet always come after the ones we do.
+SHORTEST_FIRST = 'shortest_first'  # Gets the most files done soonest
+LARGEST_FIRST = 'largest_first'  # Starts the longest downloads first, so that none of them is left running on its own at the end
+# The runs of urls each order hands out, one after the other: which urls are in the run, the columns the run is sorted on
+# and which way. Urls of the same size come in the order they were added, or the reverse for LARGEST_FIRST, which is
+# what lets a run be read straight off the downloads_state_size index.
+_runs = {
+    None: (('1', ('rowid',), 'ASC'),),
+    SHORTEST_FIRST: (('expected_size IS NOT NULL', ('expected_size', 'rowid'), 'ASC'), ('expected_size IS NULL', ('rowid',), 'ASC')),
+    LARGEST_FIRST: (('expected_size IS NOT NULL', ('expected_size', 'rowid'), 'DESC'), ('expected_size IS NULL', ('rowid',), 'ASC')),
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS downloads (
+    url TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    expected_size INTEGER,
+    checksum TEXT,
+    etag TEXT,
+    last_modified TEXT,
+    leased_to TEXT,
+    lease_expires REAL,
+    retry_after REAL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS downloads_state ON downloads (state);
+CREATE INDEX IF NOT EXISTS downloads_state_size ON downloads (state, expected_size);
+CREATE TABLE IF NOT EXISTS url_files (
+    path TEXT PRIMARY KEY,
+    offset INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    identity TEXT
+);
+"""
+
+# Columns added since the first version of the journal, which older journals need adding to them
+ADDED_COLUMNS = (('etag', 'TEXT'), ('last_modified', 'TEXT'), ('leased_to', 'TEXT'), ('lease_expires', 'REAL'), ('retry_after', 'REAL'))
+ADDED_URL_FILE_COLUMNS = (('identity', 'TEXT'),)  # The same, for the url_files table
+
+
+class DownloadJournal(object):
+    def __init__(self, fp):
+        self.fp = fp
+        self.is_new = not os.path.isfile(fp)  # A brand new journal may need to be seeded from what's already on disk (see seedFromDirectory)
+        # The download threads all share the one connection, so every use of it goes through self.lock
+        self.conn = sqlite3.connect(fp, timeout=30, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.executescript(SCHEMA)
+            for table, added in (('downloads', ADDED_COLUMNS), ('url_files', ADDED_URL_FILE_COLUMNS)):
+                columns = [row['name'] for row in self.conn.execute("PRAGMA table_info(%s)" % table)]
+                for name, type in added:
+                    if name not in columns:
+                        self.conn.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table, name, type))
+            self.conn.commit()
+
+    def _execute(self, sql, args=()):
+        with self.lock:
+            cur = self.conn.execute(sql, args)
+            self.conn.commit()
+            return cur.rowcount
+
+    # Adds any urls not already in the journal as pending. Returns the number of urls added.
+    def addURLs(self, urls):
+        now = time.time()
+        with self.lock:
+            before = self.conn.total_changes
+            self.conn.executemany("INSERT OR IGNORE INTO downloads (url, name, state, updated) VALUES (?, ?, ?, ?)",
+                                  ((url, os.path.basename(url), PENDING, now) for url in urls))
+            self.conn.commit()
+            return self.conn.total_changes - before
+
+    def markInFlight(self, url):
+        self._execute("UPDATE downloads SET state = ?, attempts = attempts + 1, updated = ? WHERE url = ?",
+                      (IN_FLIGHT, time.time(), url))
+
+    # expected_size, checksum, etag and last_modified are only overwritten when they're passed
+    def markDone(self, url, expected_size=None, checksum=None, etag=None, last_modified=None):
+        self._execute("UPDATE downloads SET state = ?, expected_size = COALESCE(?, expected_size), "
+                      "checksum = COALESCE(?, checksum), etag = COALESCE(?, etag), "
+                      "last_modified = COALESCE(?, last_modified), updated = ? WHERE url = ?",
+                      (DONE, expected_size, checksum, etag, last_modified, time.time(), url))
+
+    # expected_size, etag and last_modified are only overwritten when they're passed
+    def markVerified(self, url, expected_size=None, etag=None, last_modified=None):
+        self._execute("UPDATE downloads SET state = ?, expected_size = COALESCE(?, expected_size), "
+                      "etag = COALESCE(?, etag), last_modified = COALESCE(?, last_modified), updated = ? WHERE url = ?",
+                      (VERIFIED, expected_size, etag, last_modified, time.time(), url))
+
+    # If the server told us the size of the file before the download failed, it can be passed as expected_size. The url
+    # can be tried again straight away, unless a retry time is set with setRetryTime.
+    def markFailed(self, url, expected_size=None):
+        self._execute("UPDATE downloads SET state = ?, expected_size = COALESCE(?, expected_size), retry_after = NULL, updated = ? WHERE url = ?",
+                      (FAILED, expected_size, time.time(), url))
+
+    # Sets the earliest time a failed url may be tried again
+    def setRetryTime(self, url, retry_after):
+        self._execute("UPDATE downloads SET retry_after = ?, updated = ? WHERE url = ?", (retry_after, time.time(), url))
+
+    def markQuarantined(self, url):
+        self._execute("UPDATE downloads SET state = ?, updated = ? WHERE url = ?", (QUARANTINED, time.time(), url))
+
+    # Puts every quarantined url back to pending, with its attempts reset. Returns the number of urls released.
+    def releaseQuarantined(self):
+        return self._execute("UPDATE downloads SET state = ?, attempts = 0, retry_after = NULL, updated = ? WHERE state = ?",
+                             (PENDING, time.time(), QUARANTINED))
+
+    # Returns the number of times we've tried to download url
+    def getAttempts(self, url):
+        with self.lock:
+            row = self.conn.execute("SELECT attempts FROM downloads WHERE url = ?", (url,)).fetchone()
+            return row[0] if row is not None else 0
+
+    def markPending(self, url):
+        self._execute("UPDATE downloads SET state = ?, updated = ? WHERE url = ?", (PENDING, time.time(), url))
+
+    # Returns the urls in any of the passed states, in the order they were added to the journal.
+    def getURLs(self, *states):
+        with self.lock:
+            cur = self.conn.execute("SELECT url FROM downloads WHERE state IN (%s) ORDER BY rowid" % ','.join('?' * len(states)), states)
+            return [row[0] for row in cur.fetchall()]
+
+    # Generator version of getURLs, which only holds page_size urls in memory at a time. Urls which change state while
+    # the generator is part way through are picked up (or not) according to their new state.
+    def iterURLs(self, *states):
+        last_rowid = 0
+        while True:
+            with self.lock:
+                rows = self.conn.execute("SELECT rowid, url FROM downloads WHERE state IN (%s) AND rowid > ? ORDER BY rowid LIMIT ?" % ','.join('?' * len(states)),
+                                         states + (last_rowid, page_size)).fetchall()
+            if len(rows) == 0:
+                return
+            for row in rows:
+                yield row[1]
+            last_rowid = rows[-1][0]
+
+    # Yields the urls that are ready to be downloaded: those that are pending, and those that failed and are due to be
+    # tried again. They come in the passed order (SHORTEST_FIRST or LARGEST_FIRST, going by their expected size), or in
+    # the order they were added to the journal if order is None. Like iterURLs, only page_size urls are held in memory
+    # at a time.
+    def iterReady(self, order=None):
+        for which, columns, direction in _runs[order]:
+            order_by = ', '.join("%s %s" % (column, direction) for column in columns)
+            compare = '>' if direction == 'ASC' else '<'
+            last = None  # The sort columns of the last url handed out
+            while True:
+                now = time.time()
+                rows = []
+                # The urls after the last one handed out. Where there are two sort columns, that's the rest of the urls
+                # the same size as it, then the larger (or smaller) urls: two ranges of the index, read separately, since
+                # SQLite can't read an OR of them as a range. Row values ((a, b) > (?, ?)) would do it in one, but need
+                # SQLite 3.15 or later.
+                if last is None:
+                    afters = (("", ()),)
+                elif len(columns) == 1:
+                    afters = ((" AND rowid %s ?" % compare, last),)
+                else:
+                    afters = ((" AND %s = ? AND rowid %s ?" % (columns[0], compare), last), (" AND %s %s ?" % (columns[0], compare), last[:1]))
+                with self.lock:
+                    # A page is read for each state on its own, in order off the index, and the two merged. Sorting
+                    # pending and failed urls together would mean sorting every ready url over again for each page.
+                    for where, args in (("state = ?", (PENDING,)), ("state = ? AND (retry_after IS NULL OR retry_after <= ?)", (FAILED, now))):
+                        for after, after_args in afters:
+                            rows.extend(tuple(row) for row in self.conn.execute("SELECT %s, url FROM downloads WHERE %s AND %s%s ORDER BY %s LIMIT ?" % (', '.join(columns), where, which, after, order_by),
+                                                                                args + after_args + (page_size,)))
+                if len(rows) == 0:
+                    break
+                rows = sorted(rows, reverse=direction == 'DESC')[:page_size]
+                for row in rows:
+                    yield row[-1]
+                last = rows[-1][:-1]
+
+    # Returns the number of urls iterReady would hand out right now
+    def countReady(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM downloads WHERE state = ? OR (state = ? AND (retry_after IS NULL OR retry_after <= ?))",
+                                     (PENDING, FAILED, time.time())).fetchone()[0]
+
+    # Returns the earliest time any failed url is due to be tried again, or None if no failed url is waiting on one
+    def nextRetryTime(self):
+        with self.lock:
+            return self.conn.execute("SELECT MIN(retry_after) FROM downloads WHERE state = ?", (FAILED,)).fetchone()[0]
+
+    # Returns the full row (which can be indexed by column name) for url, or None if it isn't in the journal
+    def getEntry(self, url):
+        with self.lock:
+            return self.conn.execute("SELECT * FROM downloads WHERE url = ?", (url,)).fetchone()
+
+    # Returns the full rows (which can be indexed by column name) for the urls in any of the passed states.
+    def getEntries(self, *states):
+        with self.lock:
+            cur = self.conn.execute("SELECT * FROM downloads WHERE state IN (%s) ORDER BY rowid" % ','.join('?' * len(states)), states)
+            return cur.fetchall()
+
+    def count(self, *states):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM downloads WHERE state IN (%s)" % ','.join('?' * len(states)), states).fetchone()[0]
+
+    # Used by the coordinator (see coordinator.py) to hand out work. Leases up to count urls to worker for lease_time
+    # seconds, and returns them. Urls which are pending or failed (and due to be retried) can be leased, as can urls in
+    # flight whose lease has run out (or which never had one).
+    def leaseURLs(self, worker, count, lease_time):
+        now = time.time()
+        with self.lock:
+            rows = self.conn.execute("SELECT url FROM downloads WHERE state = ? OR (state = ? AND (retry_after IS NULL OR retry_after <= ?)) "
+                                     "OR (state = ? AND (lease_expires IS NULL OR lease_expires < ?)) ORDER BY rowid LIMIT ?",
+                                     (PENDING, FAILED, now, IN_FLIGHT, now, count)).fetchall()
+            urls = [row[0] for row in rows]
+            self.conn.executemany("UPDATE downloads SET state = ?, attempts = attempts + 1, leased_to = ?, lease_expires = ?, updated = ? WHERE url = ?",
+                                  ((IN_FLIGHT, worker, now + lease_time, now, url) for url in urls))
+            self.conn.commit()
+            return urls
+
+    # Extends worker's lease on urls by another lease_time seconds. Urls which have since been leased to someone else are
+    # left alone. Returns the number of leases renewed.
+    def renewLeases(self, worker, urls, lease_time):
+        now = time.time()
+        with self.lock:
+            before = self.conn.total_changes
+            self.conn.executemany("UPDATE downloads SET lease_expires = ?, updated = ? WHERE url = ? AND state = ? AND leased_to = ?",
+                                  ((now + lease_time, now, url, IN_FLIGHT, worker) for url in urls))
+            self.conn.commit()
+            return self.conn.total_changes - before
+
+    # Used by the coordinator to record how a leased url went: done if succeeded is true, failed otherwise. The result is
+    # only taken if worker still holds the lease on url. If the lease ran out and the url went to someone else (who may
+    # have finished it already), the result is thrown away. Returns true if the result was recorded.
+    def completeLease(self, worker, url, succeeded):
+        return self._execute("UPDATE downloads SET state = ?, retry_after = NULL, updated = ? WHERE url = ? AND state = ? AND leased_to = ?",
+                             (DONE if succeeded == True else FAILED, time.time(), url, IN_FLIGHT, worker)) > 0
+
+    # Returns a dict mapping the path of each url file we've read from to (how far into it we've read, its modification
+    # time at the time, its identity). The identity is None for files last read before identities were kept. See
+    # urlIngest.py
+    def getURLFileOffsets(self):
+        with self.lock:
+            return dict((row['path'], (row['offset'], row['mtime'], row['identity'])) for row in self.conn.execute("SELECT * FROM url_files"))
+
+    # offsets is a dict in the same form as is returned by getURLFileOffsets
+    def setURLFileOffsets(self, offsets):
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO url_files (path, offset, mtime, identity) VALUES (?, ?, ?, ?)",
+                                  ((fp, offset, mtime, identity) for fp, (offset, mtime, identity) in offsets.items()))
+            self.conn.commit()
+
+    # Any url still marked as in flight was being downloaded when the process died, so its file (if any) is only partial.
+    # Those urls are put back to pending, and returned so that the caller can deal with the partial files.
+    def recoverInFlight(self):
+        urls = self.getURLs(IN_FLIGHT)
+        self._execute("UPDATE downloads SET state = ?, updated = ? WHERE state = ?", (PENDING, time.time(), IN_FLIGHT))
+        return urls
+
+    # Brings a brand new journal up to date with a download directory that was filled before the journal existed.
+    # Any pending url with a file in dl_dir is marked done, or verified if it also has a report in reports_dir.
+    # This walks the reports directory (dl_dir has an index, see outputLayout.py), so it only needs doing once.
+    def seedFromDirectory(self, dl_dir, reports_dir=None):
+        on_disk = outputLayout.getLayout(dl_dir).presentNames()
+        checked = set(os.listdir(reports_dir)) if reports_dir is not None and os.path.isdir(reports_dir) else set()
+        now = time.time()
+        with self.lock:
+            rows = self.conn.execute("SELECT url, name FROM downloads WHERE state = ?", (PENDING,)).fetchall()
+            self.conn.executemany("UPDATE downloads SET state = ?, updated = ? WHERE url = ?",
+                                  ((VERIFIED if name in checked else DONE, now, url) for url, name in rows if name in on_disk))
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
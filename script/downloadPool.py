@@ -0,0 +1,195 @@
+"""
+Concurrent download engine used by MassDownloader.dlFilesFromList.
+
+A fixed pool of worker threads performs the transfers, while the calling thread acts as a dispatcher. The dispatcher only hands a url to the workers when three conditions are met: the total number of transfers in flight is below the global limit, the number of connections open against that url's host is below the per host limit, and (if a politeness.RequestSpacer is in use) enough time has passed since the last request to that host. Urls are grouped by host and the hosts are visited round robin, so a host which is at its limit, or which we have to wait on, never holds up work destined for any other host.
+
+Downloads that fail can be given another go later in the same run. They wait in a delayed queue (which holds neither a worker nor a connection) until they're due, and then rejoin the queue for their host.
+
+For very long lists of urls, the pool can work from a workItems.WorkItems store instead, passing integer ids around rather than url strings, and recording the results in the store rather than in a dict.
+"""
+import heapq
+import threading
+import time
+import Queue
+import urlparse
+from collections import deque
+
+pending_lookahead = 1000  # The number of jobs read ahead of the ones being worked on. Jobs are pulled from the passed iterable as they're needed, so that a huge list never has to be held in memory all at once.
+max_lookahead = 10000  # If every host we've read ahead for is at its connection limit, we'll read this far ahead looking for work for some other host.
+dispatch_poll_time = 1.0  # The number of seconds the dispatcher will wait for a transfer to finish before re-checking the queues. Python 2 can't deliver a KeyboardInterrupt to a thread blocked on an untimed wait, so this should stay finite.
+
+
+# Returns the host (and port, if present) the passed url points at. This is what connection limits are counted against.
+def getHost(url):
+    return urlparse.urlsplit(url).netloc.lower()
+
+
+class DownloadPool(object):
+    # dl_func is called as dl_func( url, f_path ) from a worker thread, and should return True on success.
+    # controller, if passed, is consulted for the number of connections each host should currently get (see
+    # serverProfiles.AdaptiveController). per_host_limit remains a hard ceiling either way.
+    # spacer, if passed, is a politeness.RequestSpacer which decides how soon after one request to a host the next may start.
+    # retry, if passed, is called as retry( url ) whenever dl_func doesn't return True, and returns the number of seconds
+    # to wait before trying url again, or None to give up on it.
+    # items, if passed, is a workItems.WorkItems store. The jobs passed to run are then (id, f_path) pairs, with ids into
+    # items in place of urls. dl_func and retry are called with the id, and the results are recorded in items.
+    def __init__(self, dl_func, max_workers, per_host_limit, controller=None, spacer=None, retry=None, items=None):
+        self.dl_func = dl_func
+        self.max_workers = max_workers
+        self.per_host_limit = per_host_limit
+        self.controller = controller
+        self.spacer = spacer
+        self.retry = retry
+        self.items = items
+        self.cond = threading.Condition()
+        self.host_active = {}  # host -> number of transfers currently running against that host
+        self.num_active = 0
+        self.num_pending = 0
+        self.delayed = []  # Heap of (time due, host, url, f_path) for the downloads waiting to be retried
+        self.results = items if items is not None else {}  # url -> value returned by dl_func, the last time it was called for that url
+
+    # The maximum number of simultaneous connections allowed against host.
+    def hostLimit(self, host):
+        if self.controller is not None:
+            return min(self.controller.limit(host), self.per_host_limit)
+        return self.per_host_limit
+
+    # Lets a download that is already running open up to count more connections to host, as long as that keeps host within
+    # its connection limit. Returns the number of connections granted, which must be handed back with
+    # releaseConnections once they're closed.
+    def acquireConnections(self, host, count):
+        with self.cond:
+            granted = max(0, min(count, self.hostLimit(host) - self.host_active.get(host, 0)))
+            self.host_active[host] = self.host_active.get(host, 0) + granted
+            return granted
+
+    def releaseConnections(self, host, count):
+        with self.cond:
+            self.host_active[host] -= count
+            self.cond.notify()
+
+    # Called with self.cond held. Returns the next (host, url, f_path) that may be started right now, or None if every
+    # host with pending work is already at its connection limit, or has to be waited on.
+    def _nextJob(self, pending, hosts):
+        for i in range(len(hosts)):
+            host = hosts[0]
+            hosts.rotate(-1)  # Round robin, so that one host with a long queue can't starve the others
+            if self.host_active.get(host, 0) >= self.hostLimit(host):
+                continue
+            if self.spacer is not None:
+                if self.spacer.delay(host) > 0:
+                    continue
+                self.spacer.reserve(host)
+            url, f_path = pending[host].popleft()
+            if len(pending[host]) == 0:
+                del pending[host]
+                hosts.remove(host)
+            return (host, url, f_path)
+        return None
+
+    # Called with self.cond held. Moves any retries that have come due back into their host's queue.
+    def _releaseDelayed(self, pending, hosts):
+        now = time.time()
+        while self.delayed and self.delayed[0][0] <= now:
+            due, host, url, f_path = heapq.heappop(self.delayed)
+            if host not in pending:
+                pending[host] = deque()
+                hosts.append(host)
+            pending[host].append((url, f_path))
+            self.num_pending += 1
+
+    # Called with self.cond held. Returns the number of seconds the dispatcher should wait before checking the queues
+    # again. If all we're waiting on is the spacer or a retry, there's no point waiting any longer than they ask.
+    def _waitTime(self, hosts):
+        wait = dispatch_poll_time
+        if self.delayed:
+            wait = min(wait, self.delayed[0][0] - time.time())
+        if self.spacer is not None:
+            for host in hosts:
+                if self.host_active.get(host, 0) < self.hostLimit(host):
+                    wait = min(wait, self.spacer.delay(host))
+        return max(wait, 0.01)
+
+    def _worker(self, work):
+        while True:
+            job = work.get()
+            if job is None:
+                return
+            host, url, f_path = job
+            try:
+                result = self.dl_func(url, f_path)
+            except Exception:
+                result = False
+            delay = None
+            if result != True and self.retry is not None:
+                try:
+                    delay = self.retry(url)
+                except Exception:
+                    delay = None
+            with self.cond:
+                self.results[url] = result
+                if delay is not None:
+                    heapq.heappush(self.delayed, (time.time() + delay, host, url, f_path))
+                self.num_active -= 1
+                self.host_active[host] -= 1
+                self.cond.notify()
+
+    # Called with self.cond held. Reads jobs into pending until count of them are waiting, or jobs runs out. Returns
+    # False once jobs has run out.
+    def _fill(self, jobs, pending, hosts, count):
+        while self.num_pending < count:
+            try:
+                url, f_path = next(jobs)
+            except StopIteration:
+                return False
+            host = self.items.host(url) if self.items is not None else getHost(url)
+            if host not in pending:
+                pending[host] = deque()
+                hosts.append(host)
+            pending[host].append((url, f_path))
+            self.num_pending += 1
+        return True
+
+    # Downloads every (url, f_path) pair in jobs, and returns a dict mapping each url to the result of its download (or
+    # the items store, if the pool was given one).
+    # jobs can be any iterable, and is only read as far ahead as is needed to keep the workers busy.
+    def run(self, jobs):
+        jobs = iter(jobs)
+        pending = {}  # host -> deque of (url, f_path) waiting to be started
+        hosts = deque()
+        self.num_pending = 0
+        more_jobs = True
+
+        work = Queue.Queue()
+        workers = [threading.Thread(target=self._worker, args=(work,)) for i in range(self.max_workers)]
+        for w in workers:
+            w.daemon = True  # Don't let a hung transfer keep the interpreter alive after an interrupt
+            w.start()
+
+        try:
+            with self.cond:
+                while True:
+                    self._releaseDelayed(pending, hosts)
+                    if more_jobs:
+                        more_jobs = self._fill(jobs, pending, hosts, pending_lookahead)
+                    job = None
+                    if self.num_active < self.max_workers:
+                        job = self._nextJob(pending, hosts)
+                        # Every host we have jobs for is busy, but there's room for more transfers. Read further ahead
+                        # in case there's some other host we could be working on.
+                        while job is None and more_jobs and self.num_pending < max_lookahead:
+                            more_jobs = self._fill(jobs, pending, hosts, min(self.num_pending + pending_lookahead, max_lookahead))
+                            job = self._nextJob(pending, hosts)
+                    if job is None:
+                        if not more_jobs and len(pending) == 0 and self.num_active == 0 and not self.delayed:
+                            break
+                        self.cond.wait(self._waitTime(hosts))
+                        continue
+                    self.num_pending -= 1
+                    self.num_active += 1
+                    self.host_active[job[0]] = self.host_active.get(job[0], 0) + 1
+                    work.put(job)
+        finally:
+            for w in workers:
+                work.put(None)
+        return self.results
@@ -22,9 +22,19 @@ import os.path
 cwd = os.getcwd()
 sys.path.append(cwd)
 import MassDownloader as md
+import downloadJournal
+import completenessChecker
+import urlIngest
+import coordinator
+import metrics
+import outputLayout
+import partFiles
+import tracing
+import workItems
 import time
-from multiprocessing import Pool
 import re
+import socket
+import urllib2
 
 verbose = True  # Set to true if you want the script to decribe its behaviour via the console.
 
@@ -34,14 +44,46 @@ check_files_silently = True  # If set to true, no file checks will print to scre
 DOWNLOAD_DIRECTORY = os.path.join(cwd, 'downloads')
 # The location on disk where all extracted files will be saved to.
 EXTRACT_DIRECTORY = os.path.join(cwd, 'downloads/extracted')
+# If set to true, the .gz files are decompressed into EXTRACT_DIRECTORY as they download.
+extract_downloads = False
+# How downloaded files are spread over subdirectories of DOWNLOAD_DIRECTORY (see outputLayout.py): outputLayout.HASHED,
+# outputLayout.PREFIX, or outputLayout.FLAT to put them all directly in it. Files already downloaded stay where they
+# are until main_migrate_layout is run.
+OUTPUT_LAYOUT = outputLayout.FLAT
 # The location on disk where all text files containing urls to download will be contained.
 url_list_directory = os.path.join(cwd, 'urls')
 completeness_reports_directory = os.path.join(cwd, r'reports\completeness')
-
-MAX_NUM_PROCS = 25
+# The SQLite database which keeps track of the state of every url (see downloadJournal.py)
+JOURNAL_FP = os.path.join(cwd, 'download_journal.sqlite')
+
+# If set, urls are leased from the coordinator running at this address (e.g. 'http://192.168.1.10:8750', see
+# coordinator.py) instead of being read from url_list_directory. That way any number of machines can share the work
+# without anyone having to split the url files up between them.
+COORDINATOR_URL = None
+LEASE_BATCH_SIZE = 20  # The number of urls asked of the coordinator at a time
+COORDINATOR_POLL_TIME = 60  # The number of seconds to wait before asking the coordinator again, when it has no work for us or can't be reached
+
+# If set, live metrics (transfer rates, stalls, failures, latencies etc., see metrics.py) are served on this port at
+# /metrics and /metrics.json. Set to None to turn the metrics server off.
+METRICS_PORT = metrics.METRICS_PORT
+METRICS_HOST = metrics.METRICS_HOST  # The metrics are only served to this machine. Set to '' to serve them on every interface.
+METRICS_SNAPSHOT_FP = os.path.join(cwd, 'metrics.json')  # A JSON snapshot of the metrics is written here periodically. Set to None to turn it off.
+METRICS_SNAPSHOT_INTERVAL = 60  # The number of seconds between metrics snapshots
+# If set, every download and completeness check is timed phase by phase (DNS, connect, the server's time to first byte,
+# the transfer, disk writes, restart waits etc., see tracing.py). When the run ends the trace is written here as Chrome
+# trace event JSON, and a summary of where the time went is printed. Tracing adds a little work to every chunk
+# downloaded, so it is off by default.
+TRACE_FP = None
+
+MAX_NUM_PROCS = 25  # The maximum number of completeness checks that will be run at the same time, across all servers
 MAX_OUTPUT_LEN = 80  # Basically the max width, in characters, of the command line prompt
 
-download_loop_threshold = 10  # The number of times that the main loop will iterate before exiting, regardless of how many urls remain to be downloaded. This is a failsafe designed to catch and kill an infinite loop if there happen to be urls in our url download list which will never sucessfully download. Without this catch, the loop would reattempt to download these files ad infinitum.
+# The order urls are downloaded in, going by the size of their files where we know it (from an earlier attempt, or a
+# completeness check). downloadJournal.LARGEST_FIRST gets the whole set done soonest, since the biggest downloads aren't
+# left running on their own at the end. downloadJournal.SHORTEST_FIRST gets the most files done soonest. None downloads
+# them in the order they were added.
+SCHEDULE_ORDER = downloadJournal.LARGEST_FIRST
+RETRY_POLL_TIME = 60  # The most seconds to wait before looking again, when every url left is waiting to be retried
 
 class FileAlreadyExistsException(Exception):
     pass
@@ -61,6 +103,10 @@ for dir in (DOWNLOAD_DIRECTORY, url_list_directory, completeness_reports_directo
     if not os.path.isdir(dir):
         createTree(dir)
 
+if extract_downloads == True:
+    md.extract_dir = EXTRACT_DIRECTORY
+outputLayout.scheme = OUTPUT_LAYOUT
+
 
 def printIfVerbose(message):
     if verbose == True:
@@ -106,16 +152,16 @@ def getListOfURLSForDownload(dir):
 # An attempt to pull out only those URLS which are viable download urls.
 # TODO The regexes aren't actually being used. They're just placeholders.
 def sanitizeURLList(urls):
-    pattern = ".*download=.*"
-    regex1 = re.compile(pattern)
+    return [url for url in urls if isViableURL(url)]
+
+
+non_viable_url_regex = re.compile(".*download=.*")
+
+
+# Returns False for urls which sanitizeURLList would throw out
+def isViableURL(url):
     # A viable download URL will not have whitespaces. Right?
-    sanitized = list()
-    for url in urls:
-        if regex1.match(url):
-            pass
-        else:
-            sanitized.append(url)
-    return sanitized
+    return not non_viable_url_regex.match(url)
 
 
 # Function which can take in a list of either filepaths, or urls, and return just the names of the files they refer to, with no file directory path attached.
@@ -133,42 +179,64 @@ def getBareNames(fps):
 
 
 # Given the download directory where the files will be saved, compile a list of all file names (no file paths) which are present in the directory
+# The names come from the directory's index (see outputLayout.py), so the directory itself is never listed.
 def getListOfDownloadedFiles(dir):
     printIfVerbose("Compiling list of previously downloaded files")
     # All downloaded files will be of extension .gz
-    files = findFilesByExtension(dir, '.gz')
-    # Remove the directory paths
-    file_names = getFileNames(files)
-    return file_names
+    return [name for name in outputLayout.getLayout(dir).presentNames() if os.path.splitext(name)[1] == '.gz']
 
 
 def findUndownloadedFiles(urls):
     to_dl = list()
     dl_check_params = list()
-    # In order to simplify the checking process, we will just use the filenames. No directory paths or extensions.
-    dl_file_names = getBareNames(os.listdir(DOWNLOAD_DIRECTORY))
-    name_hash = {}
-    for name in dl_file_names:
-        name_hash[name] = 1
+    # Whether each file is on disk, and where, is a lookup in the download directory's index
+    layout = outputLayout.getLayout(DOWNLOAD_DIRECTORY)
     for url in urls:
-        name = getBareName(url)
-        try:
-            name_hash[name]
-            # If no error is thrown, then the file is present on disk. Add it to the list of files to be checked.
-            dl_check_params.append({'url': url, 'fp': os.path.join(DOWNLOAD_DIRECTORY, os.path.basename(url))})
-        except KeyError:
+        if layout.isPresent(url):
+            # The file is present on disk. Add it to the list of files to be checked.
+            dl_check_params.append({'url': url, 'fp': layout.getPath(url)})
+        else:
             to_dl.append(url)
-            #  A key error indicated that the passed name is not in the
     return (set(to_dl), dl_check_params) # We use sets to account for potential duplicates.
 
 
 def exportUndownloadedURLList(fp):
     if os.path.isfile(fp):
         raise FileAlreadyExistsException('Error occurred while exporting undownloaded URL list:\n%s already exists' % fp)
-    urls = getListOfURLSForDownload(url_list_directory)
-    to_dl = findUndownloadedFiles(urls)[0]
+    journal = openJournal()
+    updateJournal(journal)
+    to_dl = journal.iterURLs(downloadJournal.PENDING, downloadJournal.FAILED)
     with open(fp, 'w') as file:
-        file.writelines(["%s\n" % l for l in to_dl])
+        file.writelines("%s\n" % l for l in to_dl)
+
+
+# Opens the download journal, and cleans up after any downloads which were cut off the last time the script ran.
+def openJournal():
+    journal = downloadJournal.DownloadJournal(JOURNAL_FP)
+    layout = outputLayout.getLayout(DOWNLOAD_DIRECTORY)
+    # Anything that was mid-download when we went down never got further than its .part file (see partFiles.py), which
+    # is deleted so that the download starts afresh. If the file itself is there, it was finished and put in place just
+    # before we went down.
+    for url in journal.recoverInFlight():
+        fp = layout.getPath(url)
+        partFiles.discard(fp)
+        if os.path.isfile(fp):
+            journal.markDone(url)
+            layout.record(os.path.basename(fp), fp)
+    return journal
+
+
+# Adds any new urls from the url directory to the journal. Only url files which are new or have changed since last time
+# are read (see urlIngest.py). The very first time, the journal is also brought up to date with whatever is already
+# sitting in the download directory.
+def updateJournal(journal):
+    printIfVerbose("Checking for new urls for download...")
+    added = urlIngest.URLIngester(url_list_directory, journal, isViableURL).ingest()
+    printIfVerbose("Found %s new urls for download." % added)
+    if journal.is_new:
+        printIfVerbose("Recording previously downloaded files in the download journal...")
+        journal.seedFromDirectory(DOWNLOAD_DIRECTORY, completeness_reports_directory)
+        journal.is_new = False
 
 
 # Returns a line consisting of line, followed by as many iterations of char as are needed to reach a total length of l
@@ -178,58 +246,54 @@ def fillLineRemainder(line, char, l):
     return line
 
 
-# Function which checks each file referenced by the entry in the passed list of file paths, and ensures that the file has been downloaded successfully. If it hasn't, the file is deleted. This ensures that the program will reattempt the download on the next batch of download attempts, because while the url for the deleted file will be present in the url lists, the corresponding file will not be.
-# Intended to be run as a daemon process.
-# The params should be a list of tuples, the first element of which is a url, and the second element of which is the corresponding file path
-def checkFilesForCompleteness(params):
-    # If there are no files to check, return immediatly. It is easier to put this check here rather than in the main download loop. This way, we can simply spawn the process, then join it later without checking to see if we ever actually spawned it in the first place. If we spawn the download check process, and there are no files to check, then when we try to join it we'll just join it immediatly.
-    if len(params) <= 0:
+# Function which checks each file referenced by the entry in the passed list of parameters, and ensures that the file has been downloaded successfully. If it hasn't, the file is deleted and its url is put back to pending in the journal, so that the program will reattempt the download on the next batch of download attempts.
+# The params should be a list of dicts, each with a 'url', the corresponding file path 'fp', and whatever 'expected_size', 'etag' and 'last_modified' the journal has for it (see completenessChecker.checkFile)
+# items is a workItems.WorkItems store of the urls whose files are to be checked. Each url's entry is only read out of the
+# journal as its check starts, and the journal is brought up to date as each check finishes.
+def checkFilesForCompleteness(items, journal):
+    # If there are no files to check, return immediatly.
+    if len(items) <= 0:
         return
-    for param in params:
-        url = param['url']
-        fp = param['fp']
-        file_name = os.path.basename(fp)
-        try:
-            if md.downloadComplete(url, fp) == False:
-                os.remove(fp)
-                if check_files_silently != True:  # Hacky. Not a fan of using a global variable for this. Figure out a change.
-                    printIfVerbose(
-                        fillLineRemainder("%s is fragmented. Deleting." % file_name, '-', MAX_OUTPUT_LEN - 1))
-            else:
-                if check_files_silently != True:
-                    printIfVerbose(fillLineRemainder("%s is intact." % file_name, '+', MAX_OUTPUT_LEN - 1))
-                f = open(os.path.join(completeness_reports_directory, file_name), 'w')
-                f.close()
-        except IOError:
-            continue
-
-
-# Accepts a list of parameters for file download completeness checks, and only returns those paramaters who do not have
-# a corresponding file in the completeness_reports_directory. A file present in this directory would indicate that the
-# file has already been checked for completeness and is fully intact.
-def getUncheckedFiles(params):
-    not_checked = list()
-    for p in params:
-        url = p['url']
-        fp = p['url']
-        report_fp = os.path.join(completeness_reports_directory, os.path.basename(fp))
-        if not os.path.isfile(report_fp):
-            not_checked.append(p)
-    return not_checked
-
-
-# Wrapper for the checkFilesForCompleteness function which spawns a child process to conduct the check while the main
-# process proceeds with the download. Function also returns child process so that the main function can join the child
-# process once the most recent download loop has completed.
-def beginCompletenessCheck(params):
-    params = getUncheckedFiles(
-        params)  # Determine which of the downloaded files has already been checked for completeness, and therefore
-                 # doesn't need to be checked again
-    printIfVerbose("%s files have not yet been checked." % len(params))
-    groups = divideIntoGroups(params, MAX_NUM_PROCS)
-    pool = Pool(MAX_NUM_PROCS)
-    pool.map(checkFilesForCompleteness, groups)
+    layout = outputLayout.getLayout(DOWNLOAD_DIRECTORY)
+
+    def getParam(id):
+        e = journal.getEntry(items.url(id))
+        return {'url': e['url'], 'fp': layout.getPath(e['name']),
+                'expected_size': e['expected_size'], 'etag': e['etag'], 'last_modified': e['last_modified']}
+
+    completenessChecker.checkItems(items, getParam, lambda param, result: recordCheck(param, result, journal),
+                                   MAX_NUM_PROCS, md.max_conns_per_host)
+
+
+# Brings the journal and the download directory up to date with the result of checking one file
+def recordCheck(param, result, journal):
+    url = param['url']
+    fp = param['fp']
+    file_name = os.path.basename(fp)
+    if result is None:
+        return  # The check itself failed. The file stays 'done', and will be checked again next time.
+    if result['complete'] == False:
+        if os.path.isfile(fp):
+            os.remove(fp)
+        outputLayout.getLayout(DOWNLOAD_DIRECTORY).remove(url)
+        journal.markPending(url)
+        if check_files_silently != True:  # Hacky. Not a fan of using a global variable for this. Figure out a change.
+            printIfVerbose(
+                fillLineRemainder("%s is fragmented. Deleting." % file_name, '-', MAX_OUTPUT_LEN - 1))
+    else:
+        if check_files_silently != True:
+            printIfVerbose(fillLineRemainder("%s is intact." % file_name, '+', MAX_OUTPUT_LEN - 1))
+        journal.markVerified(url, result['size'], result['etag'], result['last_modified'])
+
+
+# Wrapper for the checkFilesForCompleteness function.
+# Only files in the 'done' state should be passed in, since those are the ones which haven't been checked yet. Files
+# which are already verified cost nothing.
+def beginCompletenessCheck(items, journal):
+    printIfVerbose("%s files have not yet been checked." % len(items))
     print('Completeness check begun.')
+    checkFilesForCompleteness(items, journal)
+    printIfVerbose('Completeness check finished.')
 
 
 # Divide list into num_groups equal_sized groups, and return groups as a list of lists.
@@ -245,70 +309,174 @@ def divideIntoGroups(params, num_groups):
     return param_groups
 
 
-def main():
-    loop_count = 0
-    all_files_downloaded = False  # Variable used to ensure that all files are downloaded before the process exits,
-                                  # including lists of urls added after the process began
-    while all_files_downloaded == False:
-        loop_count += 1
-        # Refresh the url list
-        urls = getListOfURLSForDownload(url_list_directory)
-        printIfVerbose("Found %s urls for download." % len(urls))
-        # Refresh the list of downloaded files
-        files = getListOfDownloadedFiles(DOWNLOAD_DIRECTORY)
-        printIfVerbose("Found %s file already present on disk." % len(files))
-        # Using these lists, compile a list of urls which do not have corresponding files in the download directory
-        printIfVerbose("Comparing urls to downloaded files.")
-
-        to_dl, dl_check_params = findUndownloadedFiles(urls)
-
-        # beginCompletenessCheck( dl_check_params )
-        # If all files for which we have a download urls have corresponding files in our download directory, we may be
-        # done. First we need to check to see if the
-        if len(to_dl) == 0:
-            printIfVerbose("All files already downloaded.")
-            printIfVerbose("Waiting for download check to finish...")
-            # Once the download check has finished, we recompile the lists to see if anything has changed.
-            to_dl, dl_check_params = findUndownloadedFiles(urls)
-            # If the number of files to download is still 0, that means that the download check process removed no
-            # files, indicating that all downloaded files are complete.
-            if len(to_dl) == 0:
-                all_files_downloaded = True
-            # If there are still files to download, then we simply let the download loop run for another cycle. Any
-            # files deleted by the download check process well be redownloaded on the next go around.
-            continue
-            assert False
-
-        # If execution reaches this point, then there are in fact urls which need downloading still.
-        printIfVerbose("%s urls do not have corresponding files on disk. Beginning downloads..." % len(to_dl))
-        if loop_count >= download_loop_threshold:
-            # If we have tried to download these urls as many times as the download_loop_threshold allows, what it most
-            # likely means is that there is a group of urls which the server simply refuses to let us download. Every
-            # time we try, eventually the MassDownloader script gives up, logs the error and moves on. Since they never
-            # get their corresponding files added download directory, they're flagged for download every time.
-            # We'll make a list of the urls which we were unable to download, and exit the process.
-            # There is a chance that this could be erroneously triggered by the late adding of urls to the url
-            # directory, at a time when the program has already executed many times. I find this to be a fairly unlikely
-            # possiblity however.
-            message = "Number of download loop attempts exceeded."
-            tb = "No traceback stack"
-            logError(message, tb)
-            sys.exit()
-
-        # If we haven't tripped any of the above conditions, then we must be ready to proceed. Here's where the magic happens...
-        md.dlFilesFromList(to_dl, DOWNLOAD_DIRECTORY)
-        printIfVerbose("All queued downloads finished. Checking for additional downloads...")
+# Starts the metrics server and snapshot writer, whichever are turned on. Returns them both (either can be None), to be
+# passed to stopMetrics when we're done.
+def startMetrics():
+    server = None
+    if METRICS_PORT is not None:
+        try:
+            server = metrics.serve(METRICS_PORT, host=METRICS_HOST)
+            printIfVerbose("Serving metrics on %s:%s." % (METRICS_HOST or '*', METRICS_PORT))
+        except socket.error as e:
+            # Most likely another copy of the script already has the port. Not worth stopping the downloads over.
+            printIfVerbose("Could not start the metrics server on port %s: %s" % (METRICS_PORT, e))
+    if METRICS_SNAPSHOT_FP is None:
+        return (server, None)
+    writer = metrics.SnapshotWriter(METRICS_SNAPSHOT_FP, METRICS_SNAPSHOT_INTERVAL)
+    writer.start()
+    return (server, writer)
+
+
+# Writes a last snapshot of the metrics, and stops the metrics server
+def stopMetrics(server, writer):
+    if writer is not None:
+        writer.stop()
+    if server is not None:
+        server.shutdown()
+        server.server_close()
+
+
+# Starts tracing, if TRACE_FP is set
+def startTracing():
+    if TRACE_FP is not None:
+        tracing.start()
+
+
+# Writes out the trace and prints its summary, if TRACE_FP is set
+def finishTracing():
+    if TRACE_FP is None:
+        return
+    tracing.stop()
+    tracing.tracer.writeChromeTrace(TRACE_FP)
+    printIfVerbose("Timing trace written to %s. Where the time went:" % TRACE_FP)
+    printIfVerbose(tracing.tracer.formatSummary())
 
 
+def main():
+    journal = openJournal()
+    metrics_server, snapshots = startMetrics()
+    startTracing()
+    try:
+        # We keep going until all files are downloaded, including lists of urls added after the process began. Urls
+        # which never download are eventually quarantined (see backoff.py), so they can't keep us going forever.
+        while True:
+            # Pick up any urls added since the last time through the loop
+            updateJournal(journal)
+            # The journal knows which urls still need downloading, so there's no need to go looking through the download
+            # directory for them
+            num_to_dl = journal.count(downloadJournal.PENDING, downloadJournal.FAILED)
+            metrics.registry.set('download_urls_remaining', num_to_dl)
+
+            if num_to_dl == 0:
+                printIfVerbose("All files already downloaded.")
+                break
+
+            if journal.countReady() == 0:
+                # Everything left failed recently (most likely in an earlier run), and is waiting out its backoff
+                next_retry = journal.nextRetryTime() or time.time()
+                wait = min(max(0, next_retry - time.time()), RETRY_POLL_TIME)
+                printIfVerbose("%s urls are waiting to be retried. Looking again in %d seconds..." % (num_to_dl, wait))
+                time.sleep(wait)
+                continue
+
+            # If execution reaches this point, then there are in fact urls which need downloading still. Here's where the magic happens...
+            printIfVerbose("%s urls have not been downloaded yet. Beginning downloads..." % num_to_dl)
+            # The urls are read out of the journal a page at a time as the downloads get to them, and held in a
+            # compact store from then on (see workItems.py). Any that fail are retried before dlFilesFromList returns,
+            # unless they fail so often that they're quarantined.
+            to_dl = journal.iterReady(SCHEDULE_ORDER)
+            md.dlFilesFromList(to_dl, DOWNLOAD_DIRECTORY, journal)
+            printIfVerbose("All queued downloads finished. Checking for additional downloads...")
+        num_quarantined = journal.count(downloadJournal.QUARANTINED)
+        if num_quarantined > 0:
+            # Most likely the server simply refuses to let us have these. They can be given another go with
+            # main_release_quarantine.
+            message = "%s urls failed too many times, and were quarantined." % num_quarantined
+            logError(message, "No traceback stack\n")
+            printIfVerbose(message)
+    finally:
+        # Also run if we're interrupted, which is when the numbers are most wanted
+        stopMetrics(metrics_server, snapshots)
+        finishTracing()
+        journal.close()
+
+
+# The main loop for a machine taking its urls from a coordinator rather than from its own url directory.
+def main_worker():
+    journal = openJournal()
+    metrics_server, snapshots = startMetrics()
+    startTracing()
+    try:
+        client = coordinator.CoordinatorClient(COORDINATOR_URL)
+        printIfVerbose("Working for the coordinator at %s as %s" % (COORDINATOR_URL, client.worker))
+        while True:
+            try:
+                urls, lease_time = client.lease(LEASE_BATCH_SIZE)
+                if len(urls) == 0:
+                    # Everything left is either done or leased out to other workers. If any of those leases run out, the
+                    # urls will be up for grabs again, so we only stop once there's nothing outstanding at all.
+                    if client.status()['outstanding'] == 0:
+                        printIfVerbose("The coordinator has no more urls for download.")
+                        break
+                    time.sleep(COORDINATOR_POLL_TIME)
+                    continue
+                printIfVerbose("Leased %s urls for download." % len(urls))
+                journal.addURLs(urls)
+                keeper = client.keepLeases(urls, lease_time)
+                try:
+                    # Failed urls go back to the coordinator, which decides when they're retried, and by whom
+                    results = md.dlFilesFromList(urls, DOWNLOAD_DIRECTORY, journal, retry=False)
+                finally:
+                    keeper.stop()
+                client.complete(dict((url, result == True) for url, result in results.iterResults()))
+            except (urllib2.URLError, socket.error, ValueError) as e:
+                printIfVerbose("Could not reach the coordinator: %s" % e)
+                time.sleep(COORDINATOR_POLL_TIME)
+    finally:
+        stopMetrics(metrics_server, snapshots)
+        finishTracing()
+        journal.close()
+
+
+# Checks every downloaded file that hasn't been checked yet against the size the server gives for it. Files are only
+# put in place once they're complete (see partFiles.py), so there's no need to run this after a crash or reboot. It's
+# for files downloaded by older versions of the script, or copied in from elsewhere.
 def main_dl_check():
     check_files_silently = False
-    urls = getListOfURLSForDownload(url_list_directory)
-    to_dl, dl_check_params = findUndownloadedFiles(urls)
-    printIfVerbose("%s files to check." % len(dl_check_params))
+    journal = openJournal()
+    updateJournal(journal)
+    # The urls are paged out of the journal into a compact store (see workItems.py). The rest of each url's entry is read
+    # as its check starts.
+    items = workItems.fromURLs(journal.iterURLs(downloadJournal.DONE))
+    printIfVerbose("%s files to check." % len(items))
 
-    beginCompletenessCheck(dl_check_params)
+    startTracing()
+    try:
+        beginCompletenessCheck(items, journal)
+    finally:
+        finishTracing()
+        journal.close()
+
+
+# Puts every quarantined url back in line for download, for when whatever was stopping them has been sorted out
+def main_release_quarantine():
+    journal = openJournal()
+    printIfVerbose("Released %s quarantined urls." % journal.releaseQuarantined())
+    journal.close()
+
+
+# Moves every file already in DOWNLOAD_DIRECTORY to where OUTPUT_LAYOUT puts it. Can be stopped and restarted.
+def main_migrate_layout():
+    printIfVerbose("Moving downloaded files into the %s layout..." % OUTPUT_LAYOUT)
+    printIfVerbose("Moved %s files." % outputLayout.migrate(DOWNLOAD_DIRECTORY))
 
 
 if __name__ == '__main__':
-    main()
+    try:
+        if COORDINATOR_URL is not None:
+            main_worker()
+        else:
+            main()
+    except KeyboardInterrupt:
+        printIfVerbose("Interrupted. Anything left part way through will be downloaded again next time.")
     printIfVerbose("Exiting program. \"Thank you for your help!\" -Tristan")
@@ -0,0 +1,85 @@
+"""
+Decompression of .gz downloads as they stream in.
+
+A StreamExtractor is fed each chunk of a download as it is written to disk, and decompresses it straight into the extract directory. The extracted file is therefore ready the moment the download finishes, without a second pass that reads every archive back off the disk. Like the download itself, it is written under a .part name and only moved into place once it is complete (see partFiles.py). zlib releases the interpreter lock while it works, so decompression in one download thread overlaps with network reads in the others.
+
+A download that turns out not to decompress (an HTML error page served under a .gz url, say) is still a download. The extractor just gives up on it: the partly extracted file is thrown away, the error is kept in error, and everything else fed to it is ignored. The download itself carries on, and it's up to the caller to report the error.
+"""
+import os
+import os.path
+import zlib
+
+import partFiles
+
+gzip_wbits = 16 + zlib.MAX_WBITS  # Tells zlib to expect (and check) a gzip header and trailer
+
+
+class StreamExtractor(object):
+    # out_fp = the path the decompressed file is written to
+    def __init__(self, out_fp):
+        self.out_fp = out_fp
+        self.out = None
+        self.reset()
+
+    # Throws away everything extracted so far, for when a download has to start again from the beginning.
+    def reset(self):
+        if self.out is not None:
+            self.out.close()
+        out_dir = os.path.dirname(self.out_fp)
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        self.out = open(partFiles.getPartPath(self.out_fp), 'wb')
+        self.decompressor = zlib.decompressobj(gzip_wbits)  # None between one gzip member and the next
+        self.error = None  # The zlib.error the download failed to decompress with, if it did
+
+    # Gives up on extracting the download, because of the zlib.error e
+    def _fail(self, e):
+        self.error = e
+        self.out.close()
+        partFiles.discard(self.out_fp)
+
+    def update(self, data):
+        if self.error is not None:
+            return
+        try:
+            while data:
+                if self.decompressor is None:
+                    # A .gz file can be padded out with NULs after a member, which gzip skips over, and so do we
+                    data = data.lstrip('\0')
+                    if not data:
+                        return
+                    self.decompressor = zlib.decompressobj(gzip_wbits)
+                self.out.write(self.decompressor.decompress(data))
+                # A .gz file can hold several gzip members one after another. Anything left over after the end of one
+                # is padding, or the start of the next.
+                data = self.decompressor.unused_data
+                if data:
+                    self.out.write(self.decompressor.flush())
+                    self.decompressor = None
+        except zlib.error as e:
+            self._fail(e)
+
+    # Called once the download has finished. Returns False (and leaves nothing behind) if the download couldn't be
+    # extracted.
+    def finish(self):
+        if self.error is None and self.decompressor is not None:
+            try:
+                self.out.write(self.decompressor.flush())
+            except zlib.error as e:
+                self._fail(e)
+        if self.error is not None:
+            return False
+        partFiles.sync(self.out)
+        self.out.close()
+        partFiles.commit(partFiles.getPartPath(self.out_fp), self.out_fp)
+        return True
+
+    # Called if the download fails. Removes the partly extracted file.
+    def abort(self):
+        self.out.close()
+        partFiles.discard(self.out_fp)
+
+
+# Returns the path the extracted copy of the .gz file gz_fp should be written to, in extract_dir
+def getExtractedPath(gz_fp, extract_dir):
+    return os.path.join(extract_dir, os.path.splitext(os.path.basename(gz_fp))[0])
@@ -0,0 +1,353 @@
+"""
+A local stand-in for the bathymetry server, for trying out changes to the downloader without risking a ban from the real one.
+
+The server makes up its files as they're asked for (every byte of a file can be worked out from its name and position, so nothing needs to be stored), and can be set up to misbehave in all the ways the real server does:
+    - If one client has more than max_concurrent downloads open at once, ALL of its connections are dropped, and for the next ban_time seconds none of its downloads are allowed to finish.
+    - Downloads can stall partway through, sending nothing more until the client gives up on them.
+    - Downloads can be throttled to throttle_rate bytes per second.
+    - The Content-Length header can be wrong, in either direction.
+    - Connections can be reset partway through a download.
+See default_settings for everything that can be changed.
+
+The server keeps count of what it sent, and of how long it took the client to get a download through after each time it made trouble for it. benchmark.py uses these to compare downloader changes on an even footing.
+
+To run one by hand, run this script. It writes the urls of its files to flaky_urls.txt, which can be dropped into the url directory of downloadWrapper.py.
+
+Requests:
+    GET/HEAD /files/<name>   A file. Range and If-Range requests are honoured if accept_ranges is set.
+    GET /stats               What the server has sent and done so far, as JSON (see FlakyServer.stats)
+"""
+import BaseHTTPServer
+import SocketServer
+import hashlib
+import json
+import os
+import os.path
+import random
+import socket
+import struct
+import threading
+import time
+
+cwd = os.getcwd()
+SERVER_PORT = 8760  # The port the server listens on when run as a script
+url_list_fp = os.path.join(cwd, 'flaky_urls.txt')  # Where the urls of the server's files are written when run as a script
+
+default_settings = {
+    'num_files': 50,  # The number of files the server has
+    'file_size': 256 * 1024,  # The size of each file, in bytes
+    'max_concurrent': None,  # The most downloads one client may have open at once before all of them are dropped. None for no limit.
+    'ban_time': 30,  # The number of seconds after going over max_concurrent during which none of the client's downloads are allowed to finish
+    'ban_cutoff': 0.5,  # The fraction of each file sent to a banned client before its connection is cut
+    'stall_probability': 0.0,  # The chance that a download stalls partway through
+    'stall_time': 60,  # The number of seconds a stalled download sits without sending anything before the server gives up on it
+    'throttle_rate': None,  # The most bytes per second sent down any one connection. None for no limit.
+    'wrong_length_probability': 0.0,  # The chance that a download is sent with the wrong Content-Length
+    'reset_probability': 0.0,  # The chance that a download's connection is reset partway through
+    'accept_ranges': True,  # Whether Range requests are honoured
+    'seed': 0,  # Seeds the choice of which downloads misbehave, and the contents of the files
+}
+
+send_size = 16 * 1024  # The number of bytes sent at a time
+pattern_size = 64 * 1024  # Each file's contents are a block of this many bytes, repeated
+
+_patterns = {}
+_patterns_lock = threading.Lock()
+
+
+class ConnectionCutException(Exception):
+    pass
+
+
+# Returns the block of bytes that the file name is made up of, repeated
+def _pattern(name, seed):
+    key = (name, seed)
+    with _patterns_lock:
+        if key not in _patterns:
+            block = hashlib.sha512("%s:%s" % (seed, name)).digest()
+            data = []
+            while len(data) * len(block) < pattern_size:
+                block = hashlib.sha512(block).digest()
+                data.append(block)
+            _patterns[key] = ''.join(data)[:pattern_size]
+        return _patterns[key]
+
+
+# Returns length bytes of the file name, starting at offset
+def fileData(name, offset, length, seed=0):
+    pattern = _pattern(name, seed)
+    start = offset % len(pattern)
+    data = pattern[start:start + length]
+    while len(data) < length:
+        data += pattern[:length - len(data)]
+    return data
+
+
+# Returns the sha256 hex digest the file name should have, if it is size bytes long
+def fileDigest(name, size, seed=0):
+    h = hashlib.sha256()
+    for offset in range(0, size, pattern_size):
+        h.update(fileData(name, offset, min(pattern_size, size - offset), seed))
+    return h.hexdigest()
+
+
+def fileNames(settings):
+    return ['survey%05d.dat' % i for i in range(settings['num_files'])]
+
+
+class FlakyServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    # settings = a dict overriding any of default_settings
+    def __init__(self, address, settings=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address, FlakyHandler)
+        self.settings = dict(default_settings)
+        self.settings.update(settings or {})
+        self.files = set(fileNames(self.settings))
+        self.random = random.Random(self.settings['seed'])
+        self.lock = threading.Lock()
+        self.active = {}  # client address -> number of downloads it has open
+        self.epochs = {}  # client address -> number of times all of its connections have been dropped
+        self.banned_until = {}  # client address -> time its ban runs out
+        self.trouble_since = None  # The time of the first disruption the client hasn't yet recovered from
+        self.counts = {'requests': 0, 'completed': 0, 'bytes_sent': 0, 'bans': 0, 'banned_cutoffs': 0, 'stalls': 0,
+                       'wrong_lengths': 0, 'resets': 0, 'aborted_by_client': 0}
+        self.recoveries = []  # Seconds taken to get a download through after each run of disruptions
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return 'http://%s:%s' % (socket.gethostname() if host in ('', '0.0.0.0') else host, port)
+
+    def urls(self):
+        return ['%s/files/%s' % (self.base_url, name) for name in sorted(self.files)]
+
+    # Called with self.lock held, whenever the server makes trouble for a client
+    def _disrupted(self, what):
+        self.counts[what] += 1
+        if self.trouble_since is None:
+            self.trouble_since = time.time()
+
+    # Called whenever a whole file has been sent without any trouble
+    def _completed(self):
+        with self.lock:
+            self.counts['completed'] += 1
+            if self.trouble_since is not None:
+                self.recoveries.append(time.time() - self.trouble_since)
+                self.trouble_since = None
+
+    def _sent(self, num_bytes):
+        with self.lock:
+            self.counts['bytes_sent'] += num_bytes
+
+    # Registers a new download by client, and decides how the server is going to misbehave on it. Returns the client's
+    # epoch (if it changes during the download, the download is cut off) and the fault, which is None, 'banned',
+    # 'stall', 'wrong_length' or 'reset'.
+    def _startDownload(self, client):
+        now = time.time()
+        with self.lock:
+            self.counts['requests'] += 1
+            self.active[client] = self.active.get(client, 0) + 1
+            limit = self.settings['max_concurrent']
+            if limit is not None and self.active[client] > limit:
+                # Just like the real thing, drop every connection the client has, and don't let it finish anything for a while
+                self.epochs[client] = self.epochs.get(client, 0) + 1
+                self.banned_until[client] = now + self.settings['ban_time']
+                self._disrupted('bans')
+            epoch = self.epochs.get(client, 0)
+            if now < self.banned_until.get(client, 0):
+                return epoch, 'banned'
+            for fault in ('stall', 'wrong_length', 'reset'):
+                if self.random.random() < self.settings[fault + '_probability']:
+                    return epoch, fault
+            return epoch, None
+
+    def _endDownload(self, client):
+        with self.lock:
+            self.active[client] -= 1
+
+    def _epoch(self, client):
+        with self.lock:
+            return self.epochs.get(client, 0)
+
+    # Returns the counts of what the server has done so far, along with the recovery times
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts)
+            stats['recoveries'] = list(self.recoveries)
+            stats['unrecovered_since'] = self.trouble_since
+        return stats
+
+    def handle_error(self, request, client_address):
+        pass  # Clients dropping their end of a connection is business as usual here
+
+
+class FlakyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.0'
+
+    def log_message(self, format, *args):
+        pass
+
+    def finish(self):
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+        except socket.error:
+            pass  # We may well have cut the connection ourselves
+
+    def _etag(self, name):
+        return '"%s-%s"' % (name, self.server.settings['seed'])
+
+    # Returns the first and last byte the response should cover, going by the Range and If-Range headers
+    def _range(self, name, size):
+        whole = (0, size - 1)
+        value = self.headers.getheader('Range')
+        if not self.server.settings['accept_ranges'] or value is None or not value.startswith('bytes='):
+            return whole
+        if_range = self.headers.getheader('If-Range')
+        if if_range is not None and if_range != self._etag(name):
+            return whole
+        try:
+            start, end = value[len('bytes='):].split('-')
+            start = int(start)
+            end = min(int(end), size - 1) if end.strip() else size - 1
+        except ValueError:
+            return whole
+        return (start, end) if 0 <= start <= end else whole
+
+    def _sendHeaders(self, name, size, start, end, content_length):
+        if (start, end) != (0, size - 1):
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(content_length))
+        self.send_header('ETag', self._etag(name))
+        self.send_header('Last-Modified', 'Mon, 01 Jan 2018 00:00:00 GMT')
+        if self.server.settings['accept_ranges']:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+    # Drops the connection with a TCP reset, the way a server that has had enough of us does
+    def _reset(self):
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        self.connection.close()
+        raise ConnectionCutException()
+
+    def _name(self):
+        if not self.path.startswith('/files/'):
+            return None
+        name = self.path[len('/files/'):]
+        return name if name in self.server.files else None
+
+    def do_HEAD(self):
+        name = self._name()
+        if name is None:
+            self.send_error(404)
+            return
+        size = self.server.settings['file_size']
+        self._sendHeaders(name, size, 0, size - 1, size)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            data = json.dumps(self.server.stats())
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        name = self._name()
+        if name is None:
+            self.send_error(404)
+            return
+
+        server = self.server
+        settings = server.settings
+        size = settings['file_size']
+        start, end = self._range(name, size)
+        client = self.client_address[0]
+        epoch, fault = server._startDownload(client)
+        try:
+            content_length = end - start + 1
+            cut_at = None  # The number of bytes of the body sent before the fault strikes
+            if fault == 'banned':
+                cut_at = int(content_length * settings['ban_cutoff'])
+            elif fault in ('stall', 'reset'):
+                cut_at = server.random.randint(0, content_length - 1)
+            elif fault == 'wrong_length':
+                with server.lock:
+                    server._disrupted('wrong_lengths')
+                # Off by anything up to half the file. Too long and the client should notice it came up short. Too
+                # short and the file on disk is silently truncated, unless the client checks.
+                content_length += server.random.choice((-1, 1)) * server.random.randint(1, max(1, content_length / 2))
+            self._sendHeaders(name, size, start, end, content_length)
+
+            sent = 0
+            send_start = time.time()
+            body_length = end - start + 1  # What we actually send, whatever the header said
+            while sent < body_length:
+                if cut_at is not None and sent >= cut_at:
+                    break
+                if server._epoch(client) != epoch:
+                    self._reset()  # The client went over its connection limit on some other connection
+                length = min(send_size, body_length - sent)
+                if cut_at is not None:
+                    length = min(length, cut_at - sent)
+                self.wfile.write(fileData(name, start + sent, length, settings['seed']))
+                sent += length
+                server._sent(length)
+                if settings['throttle_rate'] is not None:
+                    ahead = sent / float(settings['throttle_rate']) - (time.time() - send_start)
+                    if ahead > 0:
+                        time.sleep(ahead)
+
+            if fault is None:
+                server._completed()
+            elif fault == 'banned':
+                with server.lock:
+                    server._disrupted('banned_cutoffs')
+                self._reset()
+            elif fault == 'reset':
+                with server.lock:
+                    server._disrupted('resets')
+                self._reset()
+            elif fault == 'stall':
+                with server.lock:
+                    server._disrupted('stalls')
+                self.wfile.flush()
+                time.sleep(settings['stall_time'])
+        except ConnectionCutException:
+            pass
+        except socket.error:
+            with server.lock:
+                server.counts['aborted_by_client'] += 1
+        finally:
+            server._endDownload(client)
+
+
+# Starts a FlakyServer on port (any free port, if 0) in the background, and returns it. It can be stopped with
+# shutdown().
+def start(settings=None, port=0):
+    server = FlakyServer(('127.0.0.1', port), settings)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main():
+    server = FlakyServer(('', SERVER_PORT))
+    with open(url_list_fp, 'w') as f:
+        f.writelines("%s\n" % url for url in server.urls())
+    print("Serving %s files on port %s. Their urls are in %s." % (len(server.files), SERVER_PORT, url_list_fp))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == '__main__':
+    main()
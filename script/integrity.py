@@ -0,0 +1,123 @@
+"""
+Integrity checking for downloads, done as the bytes stream in.
+
+Rather than reading every file back off the disk after it has been downloaded, each chunk is run through the hash functions on its way to the disk (see StreamHasher). By the time the download finishes its digest is already known, so it costs no extra pass over the file to write it to the manifest, or to check it against a checksum given to us by the server (a Content-MD5 or Digest header) or by a checksum list (a file in the format written by md5sum or sha256sum).
+"""
+import base64
+import binascii
+import hashlib
+import os.path
+import threading
+
+# The lengths of the hex digests of the algorithms a checksum list might use, so that we can tell which one it uses
+hex_lengths = {32: 'md5', 40: 'sha1', 64: 'sha256', 128: 'sha512'}
+# The names servers use for algorithms in Digest headers (RFC 3230 and RFC 9530), and their names in hashlib
+digest_header_algorithms = {'md5': 'md5', 'sha': 'sha1', 'sha-1': 'sha1', 'sha-256': 'sha256', 'sha-512': 'sha512'}
+
+_manifests = {}  # manifest file path -> Manifest
+_manifests_lock = threading.Lock()
+_checksum_lists = {}  # checksum list file path -> contents, see loadChecksumList
+
+
+class ChecksumMismatchException(Exception):
+    pass
+
+
+# Computes digests of a stream with several hash algorithms at once.
+class StreamHasher(object):
+    def __init__(self, algorithms):
+        self.base_algorithms = set(algorithms)
+        self.reset()
+
+    # Throws away everything hashed so far, for when a download has to start again from the beginning. Any
+    # extra_algorithms are added to the ones asked for at construction, for this stream only.
+    def reset(self, extra_algorithms=()):
+        self.hashes = dict((a, hashlib.new(a)) for a in self.base_algorithms.union(extra_algorithms))
+
+    def update(self, data):
+        for h in self.hashes.values():
+            h.update(data)
+
+    # Returns a dict mapping each algorithm to the hex digest of everything hashed so far
+    def hexdigests(self):
+        return dict((a, h.hexdigest()) for a, h in self.hashes.items())
+
+
+def _b64ToHex(value):
+    try:
+        return binascii.hexlify(base64.b64decode(value.strip().strip(':')))
+    except (TypeError, binascii.Error):
+        return None
+
+
+# Returns a dict mapping hash algorithm to the hex digest the server claims the file has, from the headers of a
+# response (a mimetools.Message, as returned by info()). Understands Content-MD5, and the Digest, Repr-Digest and
+# Content-Digest headers. These only describe the whole file when the response is for the whole file, rather than a range.
+def getServerChecksums(info):
+    checksums = {}
+    content_md5 = info.getheader('Content-MD5')
+    if content_md5:
+        checksums['md5'] = _b64ToHex(content_md5)
+    for header in ('Digest', 'Repr-Digest', 'Content-Digest'):
+        value = info.getheader(header)
+        if not value:
+            continue
+        for part in value.split(','):
+            if '=' not in part:
+                continue
+            name, encoded = part.split('=', 1)
+            algorithm = digest_header_algorithms.get(name.strip().lower())
+            if algorithm is not None:
+                checksums[algorithm] = _b64ToHex(encoded)
+    return dict((a, c) for a, c in checksums.items() if c is not None)
+
+
+# Reads a checksum list in the format written by md5sum, sha1sum, sha256sum etc. ("<hex digest>  <file name>" on each
+# line), and returns a dict mapping each file name to (algorithm, hex digest). Lists are only read once.
+def loadChecksumList(fp):
+    if fp not in _checksum_lists:
+        checksums = {}
+        with open(fp) as f:
+            for line in f:
+                parts = line.strip().split(None, 1)
+                if len(parts) != 2 or len(parts[0]) not in hex_lengths:
+                    continue
+                name = os.path.basename(parts[1].lstrip('*'))  # sha256sum marks files hashed in binary mode with a *
+                checksums[name] = (hex_lengths[len(parts[0])], parts[0].lower())
+        _checksum_lists[fp] = checksums
+    return _checksum_lists[fp]
+
+
+# Checks the digests we computed against the ones we expected, both dicts mapping algorithm to hex digest. Raises
+# ChecksumMismatchException if any algorithm in both disagrees. Returns the number of digests that were compared.
+def verify(digests, expected, name):
+    compared = 0
+    for algorithm, value in expected.items():
+        if algorithm not in digests:
+            continue
+        if digests[algorithm].lower() != value.lower():
+            raise ChecksumMismatchException("%s checksum of %s is %s, expected %s" % (algorithm, name, digests[algorithm], value))
+        compared += 1
+    return compared
+
+
+# A manifest of the digests of the files in a directory, in the same format as the checksum lists above. Lines are only
+# ever appended, so if a file is downloaded more than once the last line for it is the one that counts.
+class Manifest(object):
+    def __init__(self, fp):
+        self.fp = fp
+        self.lock = threading.Lock()
+
+    def record(self, name, hexdigest):
+        with self.lock:
+            with open(self.fp, 'a') as f:
+                f.write("%s  %s\n" % (hexdigest, name))
+
+
+# Returns the manifest of algorithm digests for the files in dl_dir
+def getManifest(dl_dir, algorithm):
+    fp = os.path.join(os.path.abspath(dl_dir), 'manifest.%s' % algorithm)
+    with _manifests_lock:
+        if fp not in _manifests:
+            _manifests[fp] = Manifest(fp)
+        return _manifests[fp]
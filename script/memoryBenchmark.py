@@ -0,0 +1,115 @@
+"""
+Memory benchmark for holding large lists of urls, to show what workItems.WorkItems saves over plain Python lists, sets and dicts.
+
+A list of made up urls, shaped like the real bathymetry ones (a directory per survey, a few files in each), is built up in each of the ways the script has held them, and the memory each takes is added up with sys.getsizeof. Anything shared between structures (the same string in two lists, say) is only counted once. For each it reports the total, and what that comes to for a million urls:
+    url list             The urls as read from the url files, one string each
+    old wrapper          Everything the wrapper used to hold while working out what to download: the urls as read, the sanitized copy, the dict of names on disk, the list and set of urls to download, and a dict for each file to check (half the files are taken to be on disk already)
+    pool results         The dict mapping every url to its result that the download pool used to return
+    work items           A workItems.WorkItems store of the urls, results and all
+
+The number of urls can be given on the command line:
+    python memoryBenchmark.py 2000000
+"""
+import os.path
+import sys
+import time
+
+import workItems
+
+num_urls = 1000000  # The number of urls to measure with, unless one is given on the command line
+files_per_survey = 4  # The number of urls that share each directory
+url_pattern = 'https://data.ngdc.noaa.gov/platforms/ocean/nos/coast/H%02d001-H%02d000/H%05d/GEODAS/H%05d_%d.xyz.gz'
+
+verbose = True
+
+
+def printIfVerbose(message):
+    if verbose == True:
+        print(message)
+
+
+# Returns a generator of num urls. Each is built fresh, the way they would be when read from a file.
+def makeURLs(num):
+    for i in xrange(num):
+        survey = i // files_per_survey
+        group = survey // 1000
+        yield url_pattern % (group, group + 1, survey, survey, i % files_per_survey)
+
+
+# Returns the number of bytes taken up by obj and everything in it, leaving out anything whose id is already in seen
+def deepSize(obj, seen):
+    total = 0
+    stack = [obj]
+    while stack:
+        o = stack.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+        total += sys.getsizeof(o)
+        if isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            stack.extend(o)
+    return total
+
+
+def measureURLList(num):
+    urls = list(makeURLs(num))
+    return deepSize(urls, set())
+
+
+# Rebuilds what getListOfURLSForDownload and findUndownloadedFiles used to hold at once
+def measureOldWrapper(num):
+    urls = list(makeURLs(num))
+    sanitized = [url for url in urls]
+    name_hash = {}
+    for url in sanitized[::2]:  # Every other file is already on disk
+        name_hash[os.path.splitext(os.path.basename(url))[0]] = 1
+    to_dl = []
+    dl_check_params = []
+    for url in sanitized:
+        if os.path.splitext(os.path.basename(url))[0] in name_hash:
+            dl_check_params.append({'url': url, 'fp': os.path.join('downloads', os.path.basename(url))})
+        else:
+            to_dl.append(url)
+    to_dl_set = set(to_dl)
+    seen = set()
+    return sum(deepSize(o, seen) for o in (urls, sanitized, name_hash, to_dl, to_dl_set, dl_check_params))
+
+
+def measurePoolResults(num):
+    results = dict((url, True) for url in makeURLs(num))
+    return deepSize(results, set())
+
+
+def measureWorkItems(num):
+    items = workItems.fromURLs(makeURLs(num))
+    for id in xrange(0, len(items), 2):
+        items[id] = True
+    return items.memoryUsage()
+
+
+measurements = [
+    ('url list', measureURLList),
+    ('old wrapper', measureOldWrapper),
+    ('pool results', measurePoolResults),
+    ('work items', measureWorkItems),
+]
+
+
+def main(num=num_urls):
+    printIfVerbose("Measuring with %s urls" % num)
+    printIfVerbose("%-14s %10s %12s %9s" % ('structure', 'MB', 'MB/million', 'seconds'))
+    results = []
+    for name, measure in measurements:
+        start_time = time.time()
+        size = measure(num)
+        elapsed = time.time() - start_time
+        results.append({'structure': name, 'bytes': size, 'bytes_per_url': float(size) / num, 'seconds': elapsed})
+        printIfVerbose("%-14s %10.1f %12.1f %9.1f" % (name, size / 1e6, size * 1e6 / num / 1e6, elapsed))
+    return results
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else num_urls)
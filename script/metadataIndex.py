@@ -0,0 +1,65 @@
+"""
+Sidecar index of what the server told us about each file we downloaded.
+
+Every download response carries the file's size (Content-Length), and usually an ETag and Last-Modified date as well. Rather than throwing those away and asking the server again later, MassDownloader records them here as each download finishes, in a small SQLite database that sits alongside the downloaded files. Checking a file for completeness is then a matter of comparing its size on disk against the index, with no request to the server at all.
+
+The index is only kept for downloads that aren't recorded in a download journal (see downloadJournal.py), such as calls straight to MassDownloader.dlFilesFromList. The journal stores the same size, ETag and Last-Modified date for each url. When there is one it is the only record, so the two can never disagree about a file.
+"""
+import os.path
+import sqlite3
+import threading
+import time
+
+index_file_name = 'download_metadata.sqlite'  # The name of the index file kept in each download directory
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    name TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    size INTEGER,
+    etag TEXT,
+    last_modified TEXT,
+    updated REAL NOT NULL
+);
+"""
+
+_indexes = {}  # dl_dir -> MetadataIndex, so that every download into a directory shares the one connection
+_indexes_lock = threading.Lock()
+
+
+class MetadataIndex(object):
+    def __init__(self, fp):
+        self.fp = fp
+        self.conn = sqlite3.connect(fp, timeout=30, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.executescript(SCHEMA)
+            self.conn.commit()
+
+    # Records what the server told us about the file name, downloaded from url. server_info is a dict as returned by
+    # MassDownloader.getResponseInfo.
+    def record(self, name, url, server_info):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO files (name, url, size, etag, last_modified, updated) VALUES (?, ?, ?, ?, ?, ?)",
+                              (name, url, server_info.get('size'), server_info.get('etag'), server_info.get('last_modified'), time.time()))
+            self.conn.commit()
+
+    # Returns the record for the file name (which can be indexed by column name), or None if we don't have one.
+    def get(self, name):
+        with self.lock:
+            return self.conn.execute("SELECT * FROM files WHERE name = ?", (name,)).fetchone()
+
+    def remove(self, name):
+        with self.lock:
+            self.conn.execute("DELETE FROM files WHERE name = ?", (name,))
+            self.conn.commit()
+
+
+# Returns the index for the download directory dl_dir, creating it if it doesn't exist yet.
+def getIndex(dl_dir):
+    dl_dir = os.path.abspath(dl_dir)
+    with _indexes_lock:
+        if dl_dir not in _indexes:
+            _indexes[dl_dir] = MetadataIndex(os.path.join(dl_dir, index_file_name))
+        return _indexes[dl_dir]
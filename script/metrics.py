@@ -0,0 +1,319 @@
+"""
+Live metrics for a download run.
+
+MassDownloader records what it is doing here as it does it: bytes received from each host, connections open, stalls and restarts, failures, and how long each part of every download took. The numbers can be watched while the run is going, either by pointing a browser (or Prometheus) at the metrics server (see serve), or by reading the JSON snapshot that is written out every so often (see SnapshotWriter). That way the concurrency and timeout settings for a long run across many machines can be tuned from what actually happened, rather than from guesses.
+
+The metrics server answers:
+    GET /metrics        Every metric, in the Prometheus text format
+    GET /metrics.json   The same, as a JSON snapshot (see Metrics.snapshot)
+"""
+import BaseHTTPServer
+import SocketServer
+import json
+import os
+import os.path
+import threading
+import time
+from collections import deque
+
+import partFiles
+
+METRICS_PORT = 8751  # The port the metrics server listens on, by default
+METRICS_HOST = '127.0.0.1'  # The address the metrics server listens on, by default. Only this machine can see the metrics, unless it's set to '' (every interface), for Prometheus to scrape them from elsewhere.
+rate_window = 60  # The number of seconds of history transfer rates are averaged over
+eta_window = 3600  # The number of seconds of history the completion rate (and so the ETA) is worked out from
+latency_buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800, 3600)  # Upper bounds, in seconds, of the latency histogram buckets
+
+# The type and description of each metric, for the Prometheus output. Anything recorded that isn't in here is still
+# reported, just without a description.
+descriptions = {
+    'download_bytes_total': ('counter', "Bytes received, by host"),
+    'download_bytes_per_second': ('gauge', "Bytes received per second over the last rate_window seconds, by host"),
+    'download_active_connections': ('gauge', "Download streams currently open, by host"),
+    'download_queue_depth': ('gauge', "Urls read ahead by the download pool and waiting for a connection"),
+    'download_completed_total': ('counter', "Files downloaded, by host"),
+    'download_skipped_total': ('counter', "Files found already on disk, which needed no download, by host"),
+    'download_failures_total': ('counter', "Downloads that failed and were left to be retried later, by host and reason"),
+    'download_quarantined_total': ('counter', "Urls given up on after failing too many times, by host"),
+    'download_restarts_total': ('counter', "Download streams restarted after stalling or timing out, by host and reason"),
+    'download_urls_remaining': ('gauge', "Urls still to be downloaded"),
+    'download_completion_eta_seconds': ('gauge', "Estimated seconds until every remaining url is downloaded, at the recent completion rate"),
+    'download_connect_seconds': ('histogram', "Time taken to open a connection to the server, by host"),
+    'download_first_byte_seconds': ('histogram', "Time from opening a download to receiving the first byte of the file, by host"),
+    'download_transfer_seconds': ('histogram', "Time from the first byte of a download to the last, by host"),
+}
+
+
+# Keeps a running total of something over the last window seconds, in one second buckets, so that a rate can be read
+# off it at any time.
+class Rate(object):
+    def __init__(self, window):
+        self.window = window
+        self.buckets = deque()  # [second, amount] for each second in the window in which anything happened
+        self.total = 0
+        self.start_time = time.time()
+
+    def _trim(self, now):
+        while self.buckets and self.buckets[0][0] <= now - self.window:
+            self.total -= self.buckets.popleft()[1]
+
+    def add(self, amount):
+        now = int(time.time())
+        if self.buckets and self.buckets[-1][0] == now:
+            self.buckets[-1][1] += amount
+        else:
+            self.buckets.append([now, amount])
+        self.total += amount
+        self._trim(now)
+
+    # The average amount per second over the window, or since we started if that was more recently
+    def perSecond(self):
+        now = time.time()
+        self._trim(int(now))
+        return float(self.total) / max(1.0, min(self.window, now - self.start_time))
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.bounds = buckets
+        self.counts = [0] * len(buckets)  # Number of observations in each bucket, not cumulative
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    # Returns a list of (upper bound, number of observations no greater than it), ending with ('+Inf', count)
+    def cumulative(self):
+        total = 0
+        result = []
+        for bound, n in zip(self.bounds, self.counts):
+            total += n
+            result.append((bound, total))
+        result.append(('+Inf', self.count))
+        return result
+
+
+# Labels are passed as dicts, but stored as sorted tuples of (name, value) pairs so that they can be used as keys
+def _labelKey(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+def _formatLabels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs)
+
+
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.counters = {}  # name -> {label key: value}
+        self.gauges = {}  # name -> {label key: value}
+        self.gauge_functions = {}  # name -> function returning the current value of the gauge
+        self.rates = {}  # name -> {label key: Rate}
+        self.histograms = {}  # name -> {label key: Histogram}
+        self.completions = Rate(eta_window)
+
+    def inc(self, name, labels=None, amount=1):
+        with self.lock:
+            values = self.counters.setdefault(name, {})
+            key = _labelKey(labels)
+            values[key] = values.get(key, 0) + amount
+
+    def set(self, name, value, labels=None):
+        with self.lock:
+            self.gauges.setdefault(name, {})[_labelKey(labels)] = value
+
+    # Adds amount (which may be negative) to a gauge
+    def add(self, name, amount, labels=None):
+        with self.lock:
+            values = self.gauges.setdefault(name, {})
+            key = _labelKey(labels)
+            values[key] = values.get(key, 0) + amount
+
+    # Makes the gauge name report whatever func returns at the time it is read, rather than a value that was set
+    def setGaugeFunction(self, name, func):
+        with self.lock:
+            self.gauge_functions[name] = func
+
+    # Records amount towards both the counter name and its rate, which is reported as the gauge rate_name
+    def mark(self, name, rate_name, amount, labels=None):
+        key = _labelKey(labels)
+        with self.lock:
+            values = self.counters.setdefault(name, {})
+            values[key] = values.get(key, 0) + amount
+            rates = self.rates.setdefault(rate_name, {})
+            if key not in rates:
+                rates[key] = Rate(rate_window)
+            rates[key].add(amount)
+
+    def observe(self, name, value, labels=None):
+        with self.lock:
+            values = self.histograms.setdefault(name, {})
+            key = _labelKey(labels)
+            if key not in values:
+                values[key] = Histogram(latency_buckets)
+            values[key].observe(value)
+
+    # Records that a file has been downloaded from host, for the completion count and the ETA
+    def recordCompletion(self, host):
+        self.inc('download_completed_total', {'host': host})
+        with self.lock:
+            self.completions.add(1)
+            remaining = self.gauges.get('download_urls_remaining', {})
+            if () in remaining:
+                remaining[()] = max(0, remaining[()] - 1)
+
+    # Records that the file for a url from host was already on disk. It no longer counts as remaining, but it doesn't
+    # count towards the completion rate either, since it took no time at all and would make the ETA far too hopeful.
+    def recordSkip(self, host):
+        self.inc('download_skipped_total', {'host': host})
+        with self.lock:
+            remaining = self.gauges.get('download_urls_remaining', {})
+            if () in remaining:
+                remaining[()] = max(0, remaining[()] - 1)
+
+    # Records that a url from host has been given up on (see backoff.py). It no longer counts as remaining.
+    def recordQuarantine(self, host):
+        self.inc('download_quarantined_total', {'host': host})
+        with self.lock:
+            remaining = self.gauges.get('download_urls_remaining', {})
+            if () in remaining:
+                remaining[()] = max(0, remaining[()] - 1)
+
+    # Called with self.lock held. Returns name -> {label key: value} for every gauge, including the computed ones.
+    def _gaugeValues(self):
+        gauges = dict((name, dict(values)) for name, values in self.gauges.items())
+        for name, func in self.gauge_functions.items():
+            try:
+                gauges[name] = {(): func()}
+            except Exception:
+                pass  # Whatever it was reporting on has gone away
+        for name, rates in self.rates.items():
+            gauges[name] = dict((key, rate.perSecond()) for key, rate in rates.items())
+        remaining = gauges.get('download_urls_remaining', {}).get(())
+        rate = self.completions.perSecond()
+        if remaining is not None and rate > 0:
+            gauges['download_completion_eta_seconds'] = {(): remaining / rate}
+        return gauges
+
+    # Returns every metric as a dict that can be written out as JSON. Labelled values are given as lists of
+    # {'labels': {...}, 'value': ...}.
+    def snapshot(self):
+        def labelled(values, convert=lambda v: v):
+            return [{'labels': dict(key), 'value': convert(value)} for key, value in sorted(values.items())]
+
+        def histogram(h):
+            return {'count': h.count, 'sum': h.sum, 'buckets': h.cumulative()}
+
+        with self.lock:
+            return {
+                'time': time.time(),
+                'uptime': time.time() - self.start_time,
+                'counters': dict((name, labelled(values)) for name, values in self.counters.items()),
+                'gauges': dict((name, labelled(values)) for name, values in self._gaugeValues().items()),
+                'histograms': dict((name, labelled(values, histogram)) for name, values in self.histograms.items()),
+            }
+
+    # Returns every metric in the Prometheus text exposition format
+    def prometheus(self):
+        lines = []
+
+        def header(name, default_type):
+            metric_type, description = descriptions.get(name, (default_type, None))
+            if description is not None:
+                lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+
+        with self.lock:
+            for name, values in sorted(self.counters.items()):
+                header(name, 'counter')
+                for key, value in sorted(values.items()):
+                    lines.append('%s%s %s' % (name, _formatLabels(key), value))
+            for name, values in sorted(self._gaugeValues().items()):
+                header(name, 'gauge')
+                for key, value in sorted(values.items()):
+                    lines.append('%s%s %s' % (name, _formatLabels(key), value))
+            for name, values in sorted(self.histograms.items()):
+                header(name, 'histogram')
+                for key, h in sorted(values.items()):
+                    for bound, count in h.cumulative():
+                        lines.append('%s_bucket%s %s' % (name, _formatLabels(key, [('le', bound)]), count))
+                    lines.append('%s_sum%s %s' % (name, _formatLabels(key), h.sum))
+                    lines.append('%s_count%s %s' % (name, _formatLabels(key), h.count))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Metrics()  # The metrics everything in this process records to
+
+
+class MetricsServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, metrics):
+        BaseHTTPServer.HTTPServer.__init__(self, address, MetricsHandler)
+        self.metrics = metrics
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass  # Being scraped every few seconds would drown out everything else on the console
+
+    def _respond(self, code, content_type, data):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self._respond(200, 'text/plain; version=0.0.4', self.server.metrics.prometheus())
+        elif self.path == '/metrics.json':
+            self._respond(200, 'application/json', json.dumps(self.server.metrics.snapshot()))
+        else:
+            self._respond(404, 'text/plain', 'Unknown path %s\n' % self.path)
+
+
+# Starts serving metrics on host:port in the background. Returns the MetricsServer, which can be stopped with shutdown().
+def serve(port=METRICS_PORT, metrics=registry, host=METRICS_HOST):
+    server = MetricsServer((host, port), metrics)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+# Background thread that writes a JSON snapshot of the metrics to fp every interval seconds, until stop() is called.
+class SnapshotWriter(threading.Thread):
+    def __init__(self, fp, interval, metrics=registry):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.fp = fp
+        self.interval = interval
+        self.metrics = metrics
+        self.stopped = threading.Event()
+
+    def write(self):
+        tmp_fp = self.fp + '.tmp'
+        with open(tmp_fp, 'w') as f:
+            json.dump(self.metrics.snapshot(), f, indent=1)
+        # Write to a temporary file and move it into place, so that anyone reading the snapshot never sees half of one
+        partFiles.replace(tmp_fp, self.fp)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    # Stops the thread, after writing one last snapshot
+    def stop(self):
+        self.stopped.set()
+        self.write()
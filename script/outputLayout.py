@@ -0,0 +1,234 @@
+"""
+Where in the download directory each downloaded file goes, and an index of which files are there.
+
+With 156,000 files sitting directly in one directory, anything that lists it or looks files up in it crawls, especially on NTFS and network drives. So files can instead be spread over a tree of subdirectories (shards), chosen from each file's name:
+    HASHED  By the leading hex digits of the MD5 of the name, which spreads files evenly however they're named
+    PREFIX  By the leading characters of the name itself, which keeps related surveys together and is easy to find your way around by hand
+    FLAT    No shards, every file directly in the download directory (the old layout)
+
+Each download directory has a small SQLite index mapping the name of every file in it to where it is, relative to the directory (so the drive can be moved once the download is done). Finding out whether a url has been downloaded, or where its file is, is a single lookup in the index, rather than a listing of the directory. The first time a directory is opened, it is walked once to build the index from whatever is already there. Because the index records where each file actually is, changing the layout doesn't lose track of anything: files already downloaded stay where they are, and only new ones go in the new place. migrate moves the old ones over, in place. It can be run from the command line:
+    python outputLayout.py DOWNLOAD_DIRECTORY [hashed|prefix|flat]
+"""
+import hashlib
+import os
+import os.path
+import sqlite3
+import sys
+import threading
+import time
+
+import metadataIndex
+import partFiles
+
+# The layouts a download directory can be in
+FLAT = 'flat'
+HASHED = 'hashed'
+PREFIX = 'prefix'
+
+scheme = FLAT  # The layout new files are put in
+shard_depth = 1  # The number of levels of subdirectories
+shard_width = 2  # The number of characters in the name of each subdirectory. Two hex digits makes for 256 shards, or around 600 files in each for the full set of 156,000.
+index_file_name = 'output_index.sqlite'  # The name of the index file kept in each download directory
+ignored_dirs = ('error_logs', 'extracted')  # Subdirectories of the download directory that don't hold downloads, and are never looked in or moved
+migrate_batch_size = 500  # The number of files moved by migrate between updates of the index
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    name TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+"""
+
+_layouts = {}  # dl_dir -> OutputLayout, so that every download into a directory shares the one connection
+_layouts_lock = threading.Lock()
+
+
+class OutputLayoutException(Exception):
+    pass
+
+
+# Returns the subdirectories (outermost first) the file name goes in, under the given layout
+def getShards(name, layout=None, depth=None, width=None):
+    layout = scheme if layout is None else layout
+    depth = shard_depth if depth is None else depth
+    width = shard_width if width is None else width
+    if layout == FLAT:
+        return []
+    if layout == HASHED:
+        key = hashlib.md5(name).hexdigest()
+    elif layout == PREFIX:
+        key = os.path.splitext(name)[0].ljust(depth * width, '_')
+    else:
+        raise OutputLayoutException("Unknown output layout %s" % layout)
+    return [key[i * width:(i + 1) * width] for i in range(depth)]
+
+
+# Returns the path, relative to the download directory, that the file name goes at under the current layout
+def getRelativePath(name):
+    return os.path.join(*(getShards(name) + [name]))
+
+
+# Returns true if the file name, found at the top of a download directory or in one of its shards, is one of our own
+# bookkeeping files rather than a download
+def isBookkeeping(name):
+    return (name.startswith(index_file_name) or name.startswith(metadataIndex.index_file_name) or name.startswith('manifest.')
+            or name == 'wrapper_err_log.txt' or os.path.splitext(name)[1] in ('.part', '.tmp'))
+
+
+class OutputLayout(object):
+    def __init__(self, dl_dir):
+        self.dl_dir = dl_dir
+        self.fp = os.path.join(dl_dir, index_file_name)
+        self.is_new = not os.path.isfile(self.fp)  # A brand new index has to be built from what's already on disk (see scan)
+        self.conn = sqlite3.connect(self.fp, timeout=30, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.made_dirs = set()  # Shards we know exist, so that we don't have to keep asking the disk
+        with self.lock:
+            self.conn.executescript(SCHEMA)
+            self.conn.commit()
+
+    # Returns the path of the file for url (or the file called name), whether or not it has been downloaded yet. Files
+    # that are on disk are wherever the index says. Anything else goes where the current layout puts it.
+    def getPath(self, url):
+        name = os.path.basename(url)
+        with self.lock:
+            row = self.conn.execute("SELECT path FROM files WHERE name = ?", (name,)).fetchone()
+        return os.path.join(self.dl_dir, row[0] if row is not None else getRelativePath(name))
+
+    # Returns the path of the file for url, making sure the shard it goes in exists
+    def prepare(self, url):
+        fp = self.getPath(url)
+        shard = os.path.dirname(fp)
+        if shard not in self.made_dirs:
+            if not os.path.isdir(shard):
+                try:
+                    os.makedirs(shard)
+                except OSError:
+                    if not os.path.isdir(shard):  # Lost a race with another thread making it
+                        raise
+            self.made_dirs.add(shard)
+        return fp
+
+    # Returns true if the file for url (or the file called name) is on disk, as far as the index knows
+    def isPresent(self, url):
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM files WHERE name = ?", (os.path.basename(url),)).fetchone() is not None
+
+    # Returns the names of every file on disk, as far as the index knows
+    def presentNames(self):
+        with self.lock:
+            return set(row[0] for row in self.conn.execute("SELECT name FROM files"))
+
+    # Returns a list of (name, path relative to the download directory) for every file on disk
+    def entries(self):
+        with self.lock:
+            return self.conn.execute("SELECT name, path FROM files").fetchall()
+
+    # Records that the file name is on disk at fp
+    def record(self, name, fp):
+        self.recordMany([(name, fp)])
+
+    def recordMany(self, files):
+        now = time.time()
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO files (name, path, updated) VALUES (?, ?, ?)",
+                                  ((name, os.path.relpath(fp, self.dl_dir), now) for name, fp in files))
+            self.conn.commit()
+
+    # Records that the file for url (or the file called name) is no longer on disk
+    def remove(self, url):
+        with self.lock:
+            self.conn.execute("DELETE FROM files WHERE name = ?", (os.path.basename(url),))
+            self.conn.commit()
+
+    # Rebuilds the index from what is actually on disk. This walks the whole directory tree, so is only done when the
+    # index is first made, and by migrate.
+    def scan(self):
+        found = {}
+        for dir, subdirs, files in os.walk(self.dl_dir):
+            if dir == self.dl_dir:
+                subdirs[:] = [d for d in subdirs if d not in ignored_dirs]
+            for name in files:
+                if not isBookkeeping(name):
+                    found[name] = os.path.relpath(os.path.join(dir, name), self.dl_dir)
+        now = time.time()
+        with self.lock:
+            self.conn.execute("DELETE FROM files")
+            self.conn.executemany("INSERT INTO files (name, path, updated) VALUES (?, ?, ?)",
+                                  ((name, path, now) for name, path in found.items()))
+            self.conn.commit()
+        self.is_new = False
+        return len(found)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+# Returns the layout of the download directory dl_dir, building its index if it doesn't have one yet.
+def getLayout(dl_dir):
+    dl_dir = os.path.abspath(dl_dir)
+    with _layouts_lock:
+        if dl_dir not in _layouts:
+            layout = OutputLayout(dl_dir)
+            if layout.is_new:
+                layout.scan()
+            _layouts[dl_dir] = layout
+        return _layouts[dl_dir]
+
+
+# Returns the download directory the file at fp belongs to, which under a sharded layout is a few levels up from the file
+# itself. The metadata index, the manifest and the error logs are all kept there.
+def getDownloadDir(fp):
+    fp = os.path.abspath(fp)
+    with _layouts_lock:
+        roots = [dl_dir for dl_dir in _layouts if fp.startswith(os.path.join(dl_dir, ''))]
+    if roots:
+        return max(roots, key=len)
+    return os.path.dirname(fp)
+
+
+# Moves every file in dl_dir to where the current layout puts it, and returns the number of files moved. Safe to stop
+# part way through and run again: the index is rebuilt from the disk before anything is moved.
+def migrate(dl_dir):
+    layout = getLayout(dl_dir)
+    layout.scan()
+    num_moved = 0
+    batch = []  # (name, new path) for the files moved since the index was last updated
+    for name, path in layout.entries():
+        target = getRelativePath(name)
+        if path == target:
+            continue
+        src = os.path.join(layout.dl_dir, path)
+        dst = os.path.join(layout.dl_dir, target)
+        if not os.path.isdir(os.path.dirname(dst)):
+            os.makedirs(os.path.dirname(dst))
+        # There should never be a file at dst already, unless one was copied in by hand
+        partFiles.replace(src, dst)
+        batch.append((name, dst))
+        num_moved += 1
+        if len(batch) >= migrate_batch_size:
+            layout.recordMany(batch)
+            batch = []
+    layout.recordMany(batch)
+    # Tidy away the shards the old layout left empty
+    for dir, subdirs, files in os.walk(layout.dl_dir, topdown=False):
+        if dir != layout.dl_dir and os.path.basename(dir) not in ignored_dirs and not os.listdir(dir):
+            os.rmdir(dir)
+    layout.made_dirs.clear()
+    return num_moved
+
+
+def main(args):
+    if len(args) not in (1, 2):
+        print("Usage: python outputLayout.py DOWNLOAD_DIRECTORY [%s|%s|%s]" % (HASHED, PREFIX, FLAT))
+        return
+    global scheme
+    if len(args) == 2:
+        scheme = args[1]
+    print("Moved %s files into the %s layout." % (migrate(args[0]), scheme))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
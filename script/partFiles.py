@@ -0,0 +1,56 @@
+"""
+Crash-safe writing of downloaded (and extracted) files.
+
+A file is never written at its final path. It is built up under the same name with .part on the end, and only once it is complete (and has passed its checks) is it flushed to disk and renamed into place. A rename is atomic, so a reboot in the middle of a download leaves nothing worse than a .part file lying around, and a file that exists under its real name is always a complete one. That's what lets a restart trust what it finds on disk, rather than checking every file over again.
+"""
+import os
+import os.path
+
+part_suffix = '.part'  # Added to the name of a file while it is being written
+sync_writes = True  # If set to true, files are forced out to disk before being renamed into place. Without it, a power cut can leave a complete-looking file full of zeros on some filesystems.
+
+
+# Returns the path the file fp is written to until it is complete
+def getPartPath(fp):
+    return fp + part_suffix
+
+
+# Makes sure everything written to the open file f has actually reached the disk
+def sync(f):
+    f.flush()
+    if sync_writes == True:
+        os.fsync(f.fileno())
+
+
+# The rename is only on disk once the directory holding the file has been synced too. Windows can't open a directory
+# like this (NTFS journals the rename itself anyway), so it is only done where the OS supports it.
+def _syncDir(dir):
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    fd = os.open(dir, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# Renames src to dst, replacing any file already at dst. Everywhere but Windows the rename does that in one atomic step.
+# Windows won't rename over an existing file, so there the old one is removed first, and for a moment there is neither.
+def replace(src, dst):
+    if os.name == 'nt' and os.path.isfile(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
+
+# Moves the finished file part_fp into place at fp. part_fp should already have been synced (see sync).
+def commit(part_fp, fp):
+    replace(part_fp, fp)
+    if sync_writes == True:
+        _syncDir(os.path.dirname(os.path.abspath(fp)))
+
+
+# Deletes the partly written file for fp, if there is one
+def discard(fp):
+    part_fp = getPartPath(fp)
+    if os.path.isfile(part_fp):
+        os.remove(part_fp)
@@ -0,0 +1,92 @@
+"""
+Keeps the downloader from drawing attention to itself, without slowing down anything it doesn't have to.
+
+Two things are kept in check, separately for each server:
+    - How often we start a request. A RequestSpacer keeps successive requests to the same server a (randomly varied) minimum time apart. The download pool consults it before handing out work, so a server we have to wait on never holds up work for any other server, and no worker thread sits idle while we wait.
+    - How fast we pull data. A BandwidthLimiter caps the transfer rate from each server, and across all servers together, with token buckets. Only the download that went over the cap waits.
+"""
+import random
+import threading
+import time
+
+
+# Keeps successive requests to the same host at least spacing seconds apart, give or take jitter (a fraction of
+# spacing). Some servers will kick you off if you don't wait at all between requests, and still others will kick you off
+# if you wait exactly the same amount of time between them.
+class RequestSpacer(object):
+    def __init__(self, spacing, jitter=0.5):
+        self.spacing = spacing
+        self.jitter = jitter
+        self.next_allowed = {}  # host -> the earliest time the next request to it may start
+        self.lock = threading.Lock()
+
+    # The number of seconds until a request to host may be started
+    def delay(self, host):
+        with self.lock:
+            return max(0.0, self.next_allowed.get(host, 0) - time.time())
+
+    # Records that a request to host is being started now
+    def reserve(self, host):
+        wait = self.spacing * random.uniform(1 - self.jitter, 1 + self.jitter)
+        with self.lock:
+            self.next_allowed[host] = time.time() + wait
+
+    # Books the next free turn for a request to host, and returns the number of seconds until it comes up. For requests
+    # made from inside a download, which can't go through the download pool.
+    def book(self, host):
+        wait = self.spacing * random.uniform(1 - self.jitter, 1 + self.jitter)
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_allowed.get(host, 0))
+            self.next_allowed[host] = start + wait
+            return start - now
+
+
+class TokenBucket(object):
+    # rate = the number of tokens added per second
+    # burst = the most tokens the bucket holds, i.e. how far a quiet spell lets us go over rate afterwards
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    # Takes amount tokens, and returns the number of seconds the caller should wait before going ahead. The bucket is
+    # allowed to go into debt, so the wait can happen outside of the lock while others take their turn behind us.
+    def take(self, amount):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+
+# Caps the rate we receive data at, from each host (host_rate) and in total (total_rate), both in bytes per second.
+# Either can be None for no cap.
+class BandwidthLimiter(object):
+    def __init__(self, host_rate=None, total_rate=None, burst_time=1.0):
+        self.host_rate = host_rate
+        self.burst_time = burst_time  # The number of seconds worth of data that may come in at once
+        self.total = TokenBucket(total_rate, total_rate * burst_time) if total_rate is not None else None
+        self.hosts = {}  # host -> TokenBucket
+        self.lock = threading.Lock()
+
+    def _hostBucket(self, host):
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = TokenBucket(self.host_rate, self.host_rate * self.burst_time)
+            return self.hosts[host]
+
+    # Called after num_bytes have been received from host. Sleeps for as long as it takes to get back under the caps.
+    def consume(self, host, num_bytes):
+        wait = 0.0
+        if self.host_rate is not None:
+            wait = self._hostBucket(host).take(num_bytes)
+        if self.total is not None:
+            wait = max(wait, self.total.take(num_bytes))
+        if wait > 0:
+            time.sleep(wait)
@@ -0,0 +1,112 @@
+"""
+Adaptive, per server concurrency control.
+
+Different servers have different tolerances for parallel connections. Rather than hand tuning a single number, the AdaptiveController starts each server at a conservative number of connections and raises it by one every time a full round of downloads completes cleanly (additive increase). When a server forcibly closes or resets our connections, the number is cut in half (multiplicative decrease) and the server is left alone for a cool down period.
+
+The highest number of connections each server has tolerated is recorded in a JSON profile on disk, and later runs start from that number instead of from scratch. Once a server has forcibly closed our connections, that number is also a ceiling: we go back up to it, but not past it, until the server has gone probe_quiet_period without dropping us. Some servers ban for hours at a time, so finding out the same limit over again is far too expensive.
+"""
+import json
+import os
+import os.path
+import threading
+import time
+
+import partFiles
+
+initial_limit = 1  # The number of connections a server we've never seen before is started at.
+additive_increase = 1  # The number of connections added after each full round of clean downloads.
+multiplicative_decrease = 0.5  # The factor the number of connections is multiplied by when the server forcibly closes a connection.
+forced_close_cooldown = 60  # The number of seconds we leave a server alone after it forcibly closes one of our connections.
+probe_quiet_period = 7 * 24 * 3600  # The number of seconds a server has to go without forcibly closing a connection before we try more connections than it last tolerated.
+
+
+def loadProfiles(fp):
+    if not os.path.isfile(fp):
+        return {}
+    try:
+        with open(fp) as f:
+            return json.load(f)
+    except ValueError:
+        # A truncated profile (from a reboot mid-write, say) isn't worth dying over. We'll just re-learn the servers.
+        return {}
+
+
+def saveProfiles(profiles, fp):
+    tmp_fp = fp + '.tmp'
+    with open(tmp_fp, 'w') as f:
+        json.dump(profiles, f, indent=2, sort_keys=True)
+    partFiles.replace(tmp_fp, fp)
+
+
+class AdaptiveController(object):
+    # profile_fp = the location of the JSON file the learned server tolerances are kept in
+    # max_limit = the number of connections we will never go above, regardless of what the server seems to tolerate
+    def __init__(self, profile_fp, max_limit):
+        self.profile_fp = profile_fp
+        self.max_limit = max_limit
+        self.lock = threading.Lock()
+        self.profiles = loadProfiles(profile_fp)
+        self.state = {}  # host -> {'limit': current number of connections, 'successes': clean downloads at this limit, 'blocked_until': end of cool down}
+
+    def _state(self, host):
+        if host not in self.state:
+            start = self.profiles.get(host, {}).get('tolerance', initial_limit)
+            self.state[host] = {'limit': float(min(max(start, 1), self.max_limit)), 'successes': 0, 'blocked_until': 0}
+        return self.state[host]
+
+    def _profile(self, host):
+        if host not in self.profiles:
+            self.profiles[host] = {'tolerance': initial_limit, 'forced_closes': 0, 'last_forced_close': None}
+        return self.profiles[host]
+
+    # Returns true if the server behind profile p has forcibly closed a connection within the last probe_quiet_period
+    # seconds, in which case its tolerance is as high as we go
+    def _recentlyClosed(self, p):
+        if p['last_forced_close'] is None:
+            return False
+        last = p.get('last_forced_close_time')
+        if last is None:
+            # Profiles written before the time was kept as a number
+            last = time.mktime(time.strptime(p['last_forced_close'], "%d/%m/%Y %H:%M:%S"))
+        return time.time() - last < probe_quiet_period
+
+    # The number of connections we should currently have open against host. Returns 0 while a server is cooling down.
+    def limit(self, host):
+        with self.lock:
+            s = self._state(host)
+            if time.time() < s['blocked_until']:
+                return 0
+            return int(s['limit'])
+
+    def recordSuccess(self, host):
+        with self.lock:
+            s = self._state(host)
+            s['successes'] += 1
+            # Only ramp up once every connection at the current level has completed a download without incident
+            if s['successes'] < int(s['limit']):
+                return
+            s['successes'] = 0
+            p = self._profile(host)
+            p['tolerance'] = max(p['tolerance'], int(s['limit']))
+            ceiling = p['tolerance'] if self._recentlyClosed(p) else self.max_limit
+            s['limit'] = min(s['limit'] + additive_increase, ceiling, self.max_limit)
+
+    def recordForcedClose(self, host):
+        with self.lock:
+            s = self._state(host)
+            if time.time() < s['blocked_until']:
+                return  # When a server drops us it drops every connection at once. Only count that as one event.
+            p = self._profile(host)
+            tripped_at = int(s['limit'])
+            p['tolerance'] = max(1, min(p['tolerance'], tripped_at - 1))
+            p['forced_closes'] += 1
+            p['last_forced_close'] = time.strftime("%d/%m/%Y %H:%M:%S")
+            p['last_forced_close_time'] = time.time()
+            s['limit'] = max(1.0, s['limit'] * multiplicative_decrease)
+            s['successes'] = 0
+            s['blocked_until'] = time.time() + forced_close_cooldown
+            saveProfiles(self.profiles, self.profile_fp)
+
+    def save(self):
+        with self.lock:
+            saveProfiles(self.profiles, self.profile_fp)
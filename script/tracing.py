@@ -0,0 +1,232 @@
+"""
+Timing traces of where each download (and each completeness check) spends its time.
+
+The metrics (see metrics.py) say how a run is going overall. When throughput drops, a trace says why: every download is broken down into spans, one for each phase it goes through, each recorded with the thread it ran on and when it started and stopped:
+    download            The whole of one file, from the pool handing it to a worker to the worker being done with it. Its own time (the time not in any of the phases below) is the bookkeeping around them.
+    journal             Keeping the download journal up to date
+    completeness_check  Checking a file already on disk against the server (see MassDownloader.downloadComplete)
+    request             Sending a request and waiting on the server's response, i.e. the server's time to first byte
+    dns                 Looking up the server's address, whenever a new connection is opened
+    connect             Opening the TCP connection
+    tls                 The TLS handshake, for https
+    preallocate         Making a file its full size before the download starts
+    transfer            Reading the file from the stream. Its own time is time spent waiting on the network.
+    disk_write          Writing to the file (see below)
+    hashing             Computing the file's checksums as it downloads
+    extraction          Decompressing .gz files as they download
+    throttle            Waiting on the bandwidth limits (see politeness.BandwidthLimiter)
+    disk_sync           Forcing the finished file out to disk
+    restart_wait        The restart_wait_time pause before picking a dead stream back up
+    request_spacing     Waiting for our turn to make a request to the server, for the extra connections of a segmented download
+    segment             One segment of a segmented download, on its own thread
+    segment_wait        Waiting for the other connections of a segmented download to finish their segments
+    verify              Comparing the file's checksums against the ones we were given
+    commit              Moving the finished file into place (see partFiles.py)
+    record              Recording the file in the manifest, the metadata index and the output layout index
+    check               One completeness check (see completenessChecker.py)
+
+Spans nest, and the time of each is counted only once, against the innermost span it falls in. A download with a request span inside it, say, has the request's time taken off its own. Reading and writing a stream happen in turns, 64KB at a time, so recording a span for every chunk would be far too many. Instead, the time spent on each chunk is added up as it goes (see Span.lap), and recorded against disk_write, hashing, extraction and throttle in one go at the end of the transfer.
+
+Tracing is off unless switched on with start(), since it adds a little work to every chunk read. A trace is written out as Chrome trace event JSON (see writeChromeTrace), which can be loaded into chrome://tracing or https://ui.perfetto.dev to see every download laid out on a timeline, one row per worker thread. The summary of where the time went across the whole run is printed by formatSummary, and kept in the trace file too, so that it can be printed again later:
+    python tracing.py trace.json
+"""
+import json
+import os
+import sys
+import threading
+import time
+
+max_events = 1000000  # The most spans kept for the timeline. Past this, spans still count towards the summary, but are left off the timeline, so that a run of millions of files doesn't run out of memory.
+
+_local = threading.local()  # The spans open on each thread, innermost last
+
+
+# A span that is being timed. Made by Tracer.span, and used as a context manager:
+#     with tracer.span('request', url=url):
+#         ...
+class Span(object):
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.laps = {}  # name -> seconds, for time within the span counted against another phase (see lap)
+        self.nested = 0.0  # Seconds spent in the spans inside this one
+        self.start = None
+        self.last = None
+
+    def __enter__(self):
+        if not hasattr(_local, 'stack'):
+            _local.stack = []
+        _local.stack.append(self)
+        self.start = self.last = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        end = time.time()
+        _local.stack.pop()
+        if _local.stack:
+            _local.stack[-1].nested += end - self.start
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.tracer.record(self, end)
+        return False
+
+    # Adds a value to the span's args, which are shown with it on the timeline
+    def set(self, key, value):
+        self.args[key] = value
+
+    # Counts the time since the last lap (or the start of the span) against the phase name, or against the span itself if
+    # name is None. For phases that happen many times a second within a span, like the disk writes in a transfer.
+    def lap(self, name=None):
+        now = time.time()
+        if name is not None:
+            self.laps[name] = self.laps.get(name, 0.0) + now - self.last
+        self.last = now
+
+
+# What Tracer.span returns while tracing is off. Does nothing, as cheaply as possible.
+class NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+    def set(self, key, value):
+        pass
+
+    def lap(self, name=None):
+        pass
+
+
+null_span = NullSpan()
+
+
+class Tracer(object):
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.clear()
+
+    # Throws away everything recorded so far
+    def clear(self):
+        with self.lock:
+            self.start_time = time.time()
+            self.end_time = None
+            self.events = []  # (name, start, duration, thread id, args) for each span on the timeline
+            self.num_dropped = 0  # The number of spans left off the timeline because of max_events
+            self.thread_names = {}  # thread id -> name
+            self.totals = {}  # phase -> [count, seconds, longest]. Seconds are the phase's own time, see the module docstring.
+
+    # Returns a new span for the phase name, to be used in a with statement. Anything passed as a keyword argument (the
+    # url, say) is shown with the span on the timeline.
+    def span(self, name, **args):
+        if self.enabled == False:
+            return null_span
+        return Span(self, name, args)
+
+    def _count(self, name, seconds, longest):
+        total = self.totals.get(name)
+        if total is None:
+            total = self.totals[name] = [0, 0.0, 0.0]
+        total[0] += 1
+        total[1] += seconds
+        total[2] = max(total[2], longest)
+
+    # Called by a span as it closes
+    def record(self, span, end):
+        duration = end - span.start
+        for name, seconds in span.laps.items():
+            span.args[name + '_seconds'] = round(seconds, 6)
+        thread = threading.current_thread()
+        with self.lock:
+            self._count(span.name, duration - span.nested - sum(span.laps.values()), duration)
+            for name, seconds in span.laps.items():
+                self._count(name, seconds, seconds)
+            if len(self.events) < max_events:
+                self.events.append((span.name, span.start, duration, thread.ident, span.args))
+                self.thread_names[thread.ident] = thread.name
+            else:
+                self.num_dropped += 1
+
+    # Returns [(phase, count, seconds, longest)] for every phase recorded, the one that took the most time first
+    def summary(self):
+        with self.lock:
+            return sorted(((name, t[0], t[1], t[2]) for name, t in self.totals.items()), key=lambda row: -row[2])
+
+    # Returns the trace in the Chrome trace event format, as a dict ready to be written out as JSON. Times are in
+    # microseconds from the start of the trace. The summary goes in otherData, which the trace viewers ignore.
+    def chromeTrace(self):
+        pid = os.getpid()
+        with self.lock:
+            end_time = self.end_time if self.end_time is not None else time.time()
+            events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+                      for tid, name in self.thread_names.items()]
+            for name, start, duration, tid, args in self.events:
+                events.append({'name': name, 'cat': 'download', 'ph': 'X', 'pid': pid, 'tid': tid,
+                               'ts': int((start - self.start_time) * 1e6), 'dur': int(duration * 1e6), 'args': args})
+            num_dropped = self.num_dropped
+        return {
+            'traceEvents': events,
+            'displayTimeUnit': 'ms',
+            'otherData': {
+                'wall_seconds': end_time - self.start_time,
+                'dropped_spans': num_dropped,
+                'summary': [{'phase': name, 'count': count, 'seconds': seconds, 'longest': longest}
+                            for name, count, seconds, longest in self.summary()],
+            },
+        }
+
+    def writeChromeTrace(self, fp):
+        with open(fp, 'w') as f:
+            json.dump(self.chromeTrace(), f)
+
+    # Returns a table of where the time went, as a string
+    def formatSummary(self):
+        end_time = self.end_time if self.end_time is not None else time.time()
+        return formatSummary(self.summary(), end_time - self.start_time)
+
+
+tracer = Tracer()  # The tracer everything in this process records to
+
+
+# Starts tracing from scratch
+def start():
+    tracer.clear()
+    tracer.enabled = True
+
+
+# Stops tracing. What was recorded is kept, to be written out.
+def stop():
+    tracer.enabled = False
+    tracer.end_time = time.time()
+
+
+# rows = [(phase, count, seconds, longest)], as returned by Tracer.summary
+# Each phase's share is of the time spent in all the phases put together, which with several downloads going at once is
+# more than the wall clock time of the run.
+def formatSummary(rows, wall_seconds):
+    busy = sum(row[2] for row in rows)
+    lines = ["Wall clock: %.1f s, time in downloads and checks: %.1f s" % (wall_seconds, busy),
+             "%-20s %9s %12s %6s %10s %10s" % ('phase', 'count', 'seconds', '%', 'mean ms', 'longest ms')]
+    for name, count, seconds, longest in rows:
+        lines.append("%-20s %9d %12.2f %6.1f %10.1f %10.1f" % (
+            name, count, seconds, 100.0 * seconds / busy if busy > 0 else 0.0, 1000.0 * seconds / count, 1000.0 * longest))
+    return '\n'.join(lines)
+
+
+# Prints the summary kept in a trace file written by writeChromeTrace
+def main(args):
+    if len(args) != 1:
+        print("Usage: python tracing.py TRACE_FILE")
+        return
+    with open(args[0]) as f:
+        data = json.load(f)['otherData']
+    print(formatSummary([(row['phase'], row['count'], row['seconds'], row['longest']) for row in data['summary']],
+                        data['wall_seconds']))
+    if data['dropped_spans'] > 0:
+        print("%s spans were left off the timeline (see max_events), but are counted above." % data['dropped_spans'])
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
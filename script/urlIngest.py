@@ -0,0 +1,83 @@
+"""
+Incremental reading of the url text files in the url directory.
+
+Rather than reading every url file from the top on every pass of the main loop, the journal (see downloadJournal.py) remembers how far into each file we've read, what its modification time was at the time, and its identity: its inode, and a hash of the first head_size bytes of it that we read. On each pass, files which haven't changed are skipped entirely, files which have been appended to are read from where we left off, and only brand new files are read in full. Files which have shrunk, or whose identity has changed because they've been replaced (by a file of any size), are read again from the top, which is harmless, since the journal ignores urls it already has.
+
+The urls are handed out one at a time by a generator, so at no point is a whole file (let alone the whole directory) held in memory.
+"""
+import hashlib
+import os
+import os.path
+import time
+
+settle_time = 10  # The number of seconds a file must go unmodified before a last line with no newline on the end is taken to be a whole url, rather than one still being written.
+head_size = 4096  # The number of bytes at the top of a url file hashed into its identity. Appending to a file never changes them.
+
+
+# Returns the identity of the open file f, which has been read as far as offset: its inode (always 0 on Windows), and a
+# hash of the first head_size bytes of it, or as many of them as we've read.
+def fileIdentity(f, offset):
+    f.seek(0)
+    head = f.read(min(offset, head_size))
+    return "%s:%s" % (os.fstat(f.fileno()).st_ino, hashlib.md5(head).hexdigest())
+
+
+class URLIngester(object):
+    # url_dir = the directory containing the url text files
+    # journal = the downloadJournal.DownloadJournal the urls are fed to, and which keeps track of how far we've read
+    # keep = an optional function which is passed each url, and returns False for urls that should be skipped
+    def __init__(self, url_dir, journal, keep=None):
+        self.url_dir = url_dir
+        self.journal = journal
+        self.keep = keep
+        self.read_to = {}  # file path -> (offset, mtime, identity) reached by the last call to newURLs, waiting to be committed
+
+    # Returns the paths of all of the .txt files in the url directory, along with their size and modification time.
+    def _listFiles(self):
+        files = []
+        for f in os.listdir(self.url_dir):
+            fp = os.path.join(self.url_dir, f)
+            if os.path.splitext(f)[1] != '.txt' or not os.path.isfile(fp):
+                continue
+            st = os.stat(fp)
+            files.append((fp, st.st_size, st.st_mtime))
+        return files
+
+    # Returns a generator which yields every url that has been added to the url directory since the last commit.
+    # The journal is consulted up front rather than from inside the generator, since the journal may well be the one
+    # consuming it (see ingest).
+    def newURLs(self):
+        offsets = self.journal.getURLFileOffsets()
+        self.read_to = {}
+        return self._readFiles(offsets)
+
+    def _readFiles(self, offsets):
+        for fp, size, mtime in self._listFiles():
+            offset, last_mtime, identity = offsets.get(fp, (0, None, None))
+            if size == offset and mtime == last_mtime:
+                continue  # Nothing has changed
+            settled = time.time() - mtime >= settle_time
+            with open(fp, 'rb') as f:
+                if size < offset or (identity is not None and fileIdentity(f, offset) != identity):
+                    offset = 0  # The file has been truncated or replaced. Start again from the top.
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith('\n') and not settled:
+                        break  # Leave a partly written last line for next time
+                    offset += len(line)
+                    url = line.strip()
+                    if url and (self.keep is None or self.keep(url)):
+                        yield url
+                self.read_to[fp] = (offset, mtime, fileIdentity(f, offset))
+
+    # Records how far through each file the last call to newURLs got. This should only be done once the urls have made
+    # it into the journal, so that urls aren't lost if we go down in between.
+    def commit(self):
+        self.journal.setURLFileOffsets(self.read_to)
+        self.read_to = {}
+
+    # Adds any new urls to the journal. Returns the number of urls added.
+    def ingest(self):
+        added = self.journal.addURLs(self.newURLs())
+        self.commit()
+        return added
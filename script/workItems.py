@@ -0,0 +1,123 @@
+"""
+Compact in-memory storage for large numbers of urls, and the results of working on them.
+
+A Python string costs around 40 bytes on top of its contents, and every list, set or dict entry that holds one adds a pointer and then some. With a few million urls, and a copy of each in every list they pass through, that comes to gigabytes. A WorkItems store instead keeps every url in a handful of flat arrays:
+    - Each url is split at its last '/'. The part before it (the server and directory) is stored once, however many urls share it, packed end to end with the other directories in a bytearray. Each url just keeps the number of its directory.
+    - The parts after (the file names) are packed end to end into another bytearray, with an array of where each one ends.
+    - How each url's download went is kept in an array alongside.
+Each url is known by its position in the store, an integer id. Ids are what get passed around between the download pool and its workers, and the url string is only rebuilt for as long as it is actually needed. See memoryBenchmark.py for what this saves.
+"""
+import sys
+from array import array
+
+import downloadPool
+
+# What is stored for each url's result
+NO_RESULT = -1
+FAILED = 0
+SUCCEEDED = 1
+
+
+# Offsets are stored as unsigned ints, which are 4 bytes everywhere (unsigned longs are 8 bytes on 64 bit Linux), so the
+# file names of all the urls in one store can come to at most 4GB.
+class WorkItems(object):
+    def __init__(self):
+        self.dirs = bytearray()  # The distinct directories, one after another
+        self.dir_ends = array('I')  # The offset in dirs just after the end of each directory, by number
+        self.dir_hosts = array('I')  # The number of each directory's host, by number
+        self.dir_numbers = {}  # hash( directory ) -> its number. A dict keyed on the directories themselves would hold a second copy of each.
+        self.hosts = []  # The distinct hosts (see downloadPool.getHost), by number
+        self.host_numbers = {}  # host -> its number
+        self.dir_of = array('I')  # The number of each url's directory, by id
+        self.names = bytearray()  # The file names of every url, one after another
+        self.name_ends = array('I')  # The offset in names just after the end of each url's file name, by id
+        self.results = array('b')  # The result (NO_RESULT, FAILED or SUCCEEDED) of each url, by id
+
+    def _dir(self, number):
+        start = self.dir_ends[number - 1] if number > 0 else 0
+        return str(self.dirs[start:self.dir_ends[number]])
+
+    # Returns the number of the directory dir, adding it if it's new
+    def _dirNumber(self, dir):
+        key = hash(dir)
+        number = self.dir_numbers.get(key)
+        if number is not None and self._dir(number) == dir:
+            return number
+        # Either a new directory, or (very rarely) one whose hash is the same as another's. The second kind is stored
+        # again each time it comes up, which costs some space but nothing else.
+        number = len(self.dir_ends)
+        self.dirs.extend(dir)
+        self.dir_ends.append(len(self.dirs))
+        host = downloadPool.getHost(dir)
+        if host not in self.host_numbers:
+            self.host_numbers[host] = len(self.hosts)
+            self.hosts.append(host)
+        self.dir_hosts.append(self.host_numbers[host])
+        if key not in self.dir_numbers:
+            self.dir_numbers[key] = number
+        return number
+
+    # Adds url to the store, and returns its id. Urls aren't checked for duplicates, so adding the same url twice gives
+    # it two ids.
+    def add(self, url):
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')  # What we get from the journal. Stored as bytes, it takes a quarter of the space.
+        split = url.rfind('/') + 1
+        self.dir_of.append(self._dirNumber(url[:split]))
+        self.names.extend(url[split:])
+        self.name_ends.append(len(self.names))
+        self.results.append(NO_RESULT)
+        return len(self.dir_of) - 1
+
+    def __len__(self):
+        return len(self.dir_of)
+
+    # Returns the file name at the end of url id (its basename)
+    def name(self, id):
+        start = self.name_ends[id - 1] if id > 0 else 0
+        return str(self.names[start:self.name_ends[id]])
+
+    def url(self, id):
+        return self._dir(self.dir_of[id]) + self.name(id)
+
+    # Returns the host url id points at, for the download pool to count connections against
+    def host(self, id):
+        return self.hosts[self.dir_hosts[self.dir_of[id]]]
+
+    # Returns True if working on url id succeeded, False if it failed, and None if it hasn't been tried
+    def result(self, id):
+        result = self.results[id]
+        return None if result == NO_RESULT else result == SUCCEEDED
+
+    # Records the result of working on url id. Anything but True counts as a failure. This is how a DownloadPool
+    # records its results, when it's given a WorkItems store to keep them in.
+    def __setitem__(self, id, result):
+        self.results[id] = SUCCEEDED if result == True else FAILED
+
+    # Returns the ids of the urls whose result is result (True, False or None), in the order they were added
+    def ids(self, result=None):
+        wanted = NO_RESULT if result is None else (SUCCEEDED if result == True else FAILED)
+        return (id for id in xrange(len(self)) if self.results[id] == wanted)
+
+    # Returns (url, result) for every url, in the order they were added. dict( items.iterResults() ) gives the same as a
+    # DownloadPool's results would have, for a small batch of urls.
+    def iterResults(self):
+        return ((self.url(id), self.result(id)) for id in xrange(len(self)))
+
+    # Returns the number of bytes the store takes up
+    def memoryUsage(self):
+        total = sys.getsizeof(self.dirs) + sys.getsizeof(self.names)
+        for a in (self.dir_ends, self.dir_hosts, self.dir_of, self.name_ends, self.results):
+            total += sys.getsizeof(a)
+        # The dict of directory numbers holds an int object for each key and (past the first few hundred) each value
+        total += sys.getsizeof(self.dir_numbers) + 2 * sys.getsizeof(sys.maxint) * len(self.dir_numbers)
+        total += sys.getsizeof(self.hosts) + sys.getsizeof(self.host_numbers) + sum(sys.getsizeof(host) for host in self.hosts)
+        return total
+
+
+# Returns a WorkItems store holding every url in urls
+def fromURLs(urls):
+    items = WorkItems()
+    for url in urls:
+        items.add(url)
+    return items